@@ -21,3 +21,10 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from . import api
 
 Client = api.Client
+
+# the asyncio client needs the optional aiohttp package
+try:
+    from . import aio
+    AsyncClient = aio.AsyncClient
+except ImportError:
+    pass
@@ -0,0 +1,362 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+# asyncio version of the modified Client, many requests can be followed
+# concurrently by one process sharing the connection pool and a polling budget
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+
+from .api import bytes_to_string, read_config
+
+
+RETRIABLE = (500, 502, 503, 504, 429, 408)
+
+
+class PollBudget(object):
+    """Limit the rate of requests sent to the server, the same budget
+       can be shared by several clients"""
+
+    def __init__(self, rate=2.0):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = None
+
+    async def wait(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+
+class AsyncResult(object):
+
+    def __init__(self, client, reply):
+
+        self.reply = reply
+
+        self._url = client.url
+        self.client = client
+        self.cleanup = client.delete
+
+        self.debug = client.debug
+        self.info = client.info
+        self.warning = client.warning
+        self.error = client.error
+
+        self._deleted = False
+
+    async def _download(self, url, size, target):
+
+        if target is None:
+            target = url.split('/')[-1]
+
+        self.info("Downloading %s to %s (%s)", url, target, bytes_to_string(size))
+        start = time.time()
+
+        session = await self.client.session()
+        total = 0
+        async with session.get(url, ssl=self.client.ssl) as r:
+            r.raise_for_status()
+            with open(target, 'wb') as f:
+                async for chunk in r.content.iter_chunked(1024 * 1024):
+                    f.write(chunk)
+                    total += len(chunk)
+
+        if total != size:
+            raise Exception("Download failed: downloaded %s byte(s) out of %s" % (total, size))
+
+        elapsed = time.time() - start
+        if elapsed:
+            self.info("Download rate %s/s", bytes_to_string(size / elapsed))
+
+        return target
+
+    async def download(self, target=None):
+        return await self._download(self.location,
+                                    self.content_length,
+                                    target)
+
+    @property
+    def content_length(self):
+        return int(self.reply['content_length'])
+
+    @property
+    def location(self):
+        return self.reply['location']
+
+    @property
+    def content_type(self):
+        return self.reply['content_type']
+
+    def __repr__(self):
+        return "AsyncResult(content_length=%s,content_type=%s,location=%s)" % (self.content_length,
+                                                                               self.content_type,
+                                                                               self.location)
+
+    async def delete(self):
+
+        if self._deleted:
+            return
+
+        if 'request_id' in self.reply:
+            rid = self.reply['request_id']
+
+            task_url = '%s/tasks/%s' % (self._url, rid)
+            self.debug("DELETE %s", task_url)
+
+            session = await self.client.session()
+            async with session.delete(task_url, ssl=self.client.ssl) as delete:
+                self.debug("DELETE returns %s %s", delete.status, delete.reason)
+                if delete.status >= 400:
+                    self.warning("DELETE %s returns %s %s",
+                                 task_url, delete.status, delete.reason)
+
+            self._deleted = True
+
+
+class AsyncClient(object):
+    """Same retrieve/Result surface as Client, but all methods are coroutines.
+       All requests share one aiohttp session with at most max_connections
+       connections, and every GET/POST to the server waits on the budget
+       (a PollBudget, by default poll_rate requests/s for this client).
+
+       async with AsyncClient() as c:
+           results = await asyncio.gather(*[c.retrieve(name, r) for r in requests])
+    """
+
+    logger = logging.getLogger('cdsapi')
+
+    def __init__(self,
+                 url=os.environ.get('CDSAPI_URL'),
+                 key=os.environ.get('CDSAPI_KEY'),
+                 verify=None,
+                 timeout=None,
+                 full_stack=False,
+                 delete=True,
+                 retry_max=500,
+                 sleep_max=120,
+                 max_connections=20,
+                 poll_rate=2.0,
+                 budget=None,
+                 info_callback=None,
+                 warning_callback=None,
+                 error_callback=None,
+                 debug_callback=None,
+                 ):
+
+        dotrc = os.environ.get('CDSAPI_RC', os.path.expanduser('~/.cdsapirc'))
+
+        if url is None or key is None:
+            if os.path.exists(dotrc):
+                config = read_config(dotrc)
+
+                if key is None:
+                    key = config.get('key')
+
+                if url is None:
+                    url = config.get('url')
+
+                if verify is None:
+                    verify = int(config.get('verify', 1))
+
+        if url is None or key is None:
+            raise Exception('Missing/incomplete configuration file: %s' % (dotrc))
+
+        self.url = url
+        self.key = key
+
+        self.verify = True if verify else False
+        self.ssl = None if self.verify else False
+        self.timeout = timeout
+        self.sleep_max = sleep_max
+        self.retry_max = retry_max
+        self.full_stack = full_stack
+        self.delete = delete
+        self.max_connections = max_connections
+        self.budget = budget if budget is not None else PollBudget(poll_rate)
+
+        self.debug_callback = debug_callback
+        self.warning_callback = warning_callback
+        self.info_callback = info_callback
+        self.error_callback = error_callback
+
+        self._session = None
+
+    async def session(self):
+        # the session has to be created inside the running event loop
+        if self._session is None:
+            user, password = self.key.split(':', 1)
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(auth=aiohttp.BasicAuth(user, password),
+                                                  connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def retrieve(self, name, request, target=None):
+        result = await self._api('%s/resources/%s' % (self.url, name), request)
+        if target is not None:
+            await result.download(target)
+        return result
+
+    async def submit(self, name, request):
+        """Submit a request and return the first reply without waiting"""
+        return await self._post('%s/resources/%s' % (self.url, name), request)
+
+    async def poll(self, reply):
+        """Get the current state of a submitted task"""
+        task_url = '%s/tasks/%s' % (self.url, reply['request_id'])
+        self.debug("GET %s", task_url)
+        status, reply = await self._robust('GET', task_url)
+        if status >= 400:
+            raise Exception("GET %s returns %s: %s" % (task_url, status, reply))
+        return reply
+
+    def result(self, reply):
+        """Return an AsyncResult if the task is completed, None if it is still
+           queued or running, raise an exception if it failed
+        """
+        self.debug("REPLY %s", reply)
+
+        if reply['state'] == 'completed':
+            return AsyncResult(self, reply)
+
+        if reply['state'] in ('queued', 'running'):
+            return None
+
+        if reply['state'] in ('failed',):
+            self.error("Message: %s", reply['error'].get('message'))
+            self.error("Reason:  %s", reply['error'].get('reason'))
+            for n in reply.get('error', {}).get('context', {}).get('traceback', '').split('\n'):
+                if n.strip() == '' and not self.full_stack:
+                    break
+                self.error("  %s", n)
+            raise Exception("%s. %s." % (reply['error'].get('message'), reply['error'].get('reason')))
+
+        raise Exception('Unknown API state [%s]' % (reply['state'],))
+
+    async def _post(self, url, request):
+
+        self.info("Sending request to %s", url)
+        self.debug("POST %s %s", url, json.dumps(request))
+
+        status, reply = await self._robust('POST', url, json=request)
+
+        if status >= 400:
+            self.debug(json.dumps(reply))
+            error = reply.get('message', 'POST %s returns %s' % (url, status))
+            if 'context' in reply and 'required_terms' in reply['context']:
+                e = [error]
+                for t in reply['context']['required_terms']:
+                    e.append("To access this resource, you first need to accept the terms"
+                             "of '%s' at %s" % (t['title'], t['url']))
+                error = '. '.join(e)
+            raise Exception(error)
+
+        return reply
+
+    async def _api(self, url, request):
+
+        reply = await self._post(url, request)
+
+        sleep = 1
+        start = time.time()
+        last_state = None
+
+        while True:
+
+            if reply['state'] != last_state:
+                self.info("Request %s is %s", reply.get('request_id'), reply['state'])
+                last_state = reply['state']
+
+            result = self.result(reply)
+            if result is not None:
+                return result
+
+            if self.timeout and (time.time() - start > self.timeout):
+                raise Exception('TIMEOUT')
+
+            await asyncio.sleep(sleep)
+            sleep *= 1.5
+            if sleep > self.sleep_max:
+                sleep = self.sleep_max
+
+            reply = await self.poll(reply)
+
+    async def _robust(self, method, url, **kwargs):
+        """Send a request waiting on the polling budget, retry on connection
+           errors and retriable HTTP codes. Return status and json reply
+        """
+        session = await self.session()
+        tries = 0
+        while tries < self.retry_max:
+            await self.budget.wait()
+            try:
+                async with session.request(method, url, ssl=self.ssl, **kwargs) as r:
+                    if r.status not in RETRIABLE:
+                        try:
+                            reply = await r.json(content_type=None)
+                        except ValueError:
+                            reply = dict(message=await r.text())
+                        return r.status, reply
+                    self.warning("Recovering from HTTP error [%s %s], attemps %s of %s",
+                                 r.status, r.reason, tries, self.retry_max)
+            except aiohttp.ClientConnectionError as e:
+                self.warning("Recovering from connection error [%s], attemps %s of %s",
+                             e, tries, self.retry_max)
+
+            tries += 1
+
+            self.warning("Retrying in %s seconds", self.sleep_max)
+            await asyncio.sleep(self.sleep_max)
+
+        raise Exception('Could not connect to %s after %s attempts' % (url, tries))
+
+    def info(self, *args, **kwargs):
+        if self.info_callback:
+            self.info_callback(*args, **kwargs)
+        else:
+            self.logger.info(*args, **kwargs)
+
+    def warning(self, *args, **kwargs):
+        if self.warning_callback:
+            self.warning_callback(*args, **kwargs)
+        else:
+            self.logger.warning(*args, **kwargs)
+
+    def error(self, *args, **kwargs):
+        if self.error_callback:
+            self.error_callback(*args, **kwargs)
+        else:
+            self.logger.error(*args, **kwargs)
+
+    def debug(self, *args, **kwargs):
+        if self.debug_callback:
+            self.debug_callback(*args, **kwargs)
+        else:
+            self.logger.debug(*args, **kwargs)
@@ -73,7 +73,7 @@ class Result(object):
 
             total = 0
             with open(target, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
+                for chunk in r.iter_content(chunk_size=1024*1024):
                     if chunk:
                         f.write(chunk)
                         total += len(chunk)
@@ -235,10 +235,62 @@ class Client(object):
         #    result.download(target)
         return result
 
+    def submit(self, name, request):
+        """Submit a request and return the first reply without waiting
+           for the task to complete, use poll() and result() to follow it
+        """
+        return self._post('%s/resources/%s' % (self.url, name), request)
+
+    def poll(self, reply):
+        """Get the current state of a submitted task"""
+        rid = reply['request_id']
+        task_url = '%s/tasks/%s' % (self.url, rid)
+        self.debug("GET %s", task_url)
+
+        result = self.robust(self.session.get)(task_url, verify=self.verify)
+        result.raise_for_status()
+        return result.json()
+
+    def cancel(self, reply):
+        """Delete a submitted task from the server"""
+        task_url = '%s/tasks/%s' % (self.url, reply['request_id'])
+        self.debug("DELETE %s", task_url)
+
+        result = self.robust(self.session.delete)(task_url, verify=self.verify)
+        result.raise_for_status()
+
+    def result(self, reply):
+        """Return a Result if the task is completed, None if it is still
+           queued or running, raise an exception if it failed
+        """
+        self.debug("REPLY %s", reply)
+
+        if reply['state'] != self.last_state:
+            self.info("Request is %s" % (reply['state'],))
+            self.last_state = reply['state']
+
+        if reply['state'] == 'completed':
+            self.debug("Done")
+            return Result(self, reply)
+
+        if reply['state'] in ('queued', 'running'):
+            return None
+
+        if reply['state'] in ('failed',):
+            self.error("Message: %s", reply['error'].get('message'))
+            self.error("Reason:  %s", reply['error'].get('reason'))
+            for n in reply.get('error', {}).get('context', {}).get('traceback', '').split('\n'):
+                if n.strip() == '' and not self.full_stack:
+                    break
+                self.error("  %s", n)
+            raise Exception("%s. %s." % (reply['error'].get('message'), reply['error'].get('reason')))
+
+        raise Exception('Unknown API state [%s]' % (reply['state'],))
+
     def identity(self):
         return self._api('%s/resources' % (self.url,), {})
 
-    def _api(self, url, request):
+    def _post(self, url, request):
 
         session = self.session
 
@@ -274,51 +326,33 @@ class Client(object):
             else:
                 raise
 
-        sleep = 1
-        start = time.time()
-
-        while True:
+        return reply
 
-            self.debug("REPLY %s", reply)
-
-            if reply['state'] != self.last_state:
-                self.info("Request is %s" % (reply['state'],))
-                self.last_state = reply['state']
+    def _api(self, url, request):
 
-            if reply['state'] == 'completed':
-                self.debug("Done")
-                return Result(self, reply)
+        reply = self._post(url, request)
 
-            if reply['state'] in ('queued', 'running'):
-                rid = reply['request_id']
+        sleep = 1
+        start = time.time()
 
-                if self.timeout and (time.time() - start > self.timeout):
-                    raise Exception('TIMEOUT')
+        while True:
 
-                self.debug("Request ID is %s, sleep %s", rid, sleep)
-                time.sleep(sleep)
-                sleep *= 1.5
-                if sleep > self.sleep_max:
-                    sleep = self.sleep_max
+            result = self.result(reply)
+            if result is not None:
+                return result
 
-                task_url = '%s/tasks/%s' % (self.url, rid)
-                self.debug("GET %s", task_url)
+            rid = reply['request_id']
 
-                result = self.robust(session.get)(task_url, verify=self.verify)
-                result.raise_for_status()
-                reply = result.json()
-                continue
+            if self.timeout and (time.time() - start > self.timeout):
+                raise Exception('TIMEOUT')
 
-            if reply['state'] in ('failed',):
-                self.error("Message: %s", reply['error'].get('message'))
-                self.error("Reason:  %s", reply['error'].get('reason'))
-                for n in reply.get('error', {}).get('context', {}).get('traceback', '').split('\n'):
-                    if n.strip() == '' and not self.full_stack:
-                        break
-                    self.error("  %s", n)
-                raise Exception("%s. %s." % (reply['error'].get('message'), reply['error'].get('reason')))
+            self.debug("Request ID is %s, sleep %s", rid, sleep)
+            time.sleep(sleep)
+            sleep *= 1.5
+            if sleep > self.sleep_max:
+                sleep = self.sleep_max
 
-            raise Exception('Unknown API state [%s]' % (reply['state'],))
+            reply = self.poll(reply)
 
     def info(self, *args, **kwargs):
         if self.info_callback:
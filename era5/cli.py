@@ -31,16 +31,32 @@
 # last updated 09/06/2020
 #!/usr/bin/python
 
+import time
+_start = time.perf_counter()
+import builtins
 import click
+import hashlib
+import json
+import logging
 import os
+import subprocess as sp
 import sys
-import yaml
 from itertools import product as iproduct
-from multiprocessing.dummy import Pool as ThreadPool
-#from era5.era5_update_db import db_connect, query
-from era5.era5_functions import *
-from era5.era5_db import query, db_connect, update_db, delete_record, variables_stats
-import era5.cdsapi as cdsapi
+from era5.era5_functions import (cfg, config_log, define_var, define_args, read_vars,
+     file_exists, build_dict, build_mars, file_down, download_complete, downloaded_bytes,
+     target, dump_args)
+from era5.era5_db import db_connect, existing_files, update_db, delete_record, variables_stats
+from era5.era5_metadata import grib_code
+from era5.era5_compress import have_netcdf4
+from era5.era5_jobs import get_jobs
+from era5.era5_mirrors import get_mirrors
+from era5.era5_governor import get_governor
+from era5.era5_metrics import get_metrics
+from era5.era5_verify import check_file, file_checksum, new_digest
+from era5.era5_cost import estimate, nparts, split_days, group_vars
+from era5.era5_place import place_file, purge_staging
+# modules needing requests, yaml or netCDF4 are imported only by the subcommands using them
+_imported = time.perf_counter()
 
 
 def era5_catch():
@@ -54,87 +70,209 @@ def era5_catch():
         sys.exit(1)
 
 
-def do_request(r):
+def file_done(r, path, outputs, checksum=None):
+    """ Add output file path of request r and its checksum to the catalogue,
+        the staging file is removed when all outputs are catalogued
     """
-    Issue the download request. param 'r' is a tuple:
+    if path.startswith(cfg['derivdir']):
+        basedir = cfg['derivdir']
+    else:
+        basedir = cfg['datadir']
+    with get_metrics(cfg).timer('catalogue', r[3]):
+        catalogued = get_jobs(cfg).file_done(r[3], path, outputs, basedir, checksum)
+    if catalogued and cfg.get('purge_staging', True):
+        purge_staging(r[2], era5log)
+
+
+def request_outputs(r):
+    """ Return the output files of request r
+    """
+    if r[3][-4:] in ['.tgz', '.zip']:
+        return [r[3][:-4] + '.nc']
+    return [vfn for var, vfn in r[6]] or [r[3]]
+
+
+def not_catalogued(rqlist):
+    """ Return the requests with output files not in the catalogue
+    """
+    conn = db_connect(cfg)
+    locations = []
+    for r in rqlist:
+        for path in request_outputs(r):
+            base = cfg['derivdir'] if path.startswith(cfg['derivdir']) else cfg['datadir']
+            locations.append(os.path.relpath(os.path.dirname(path), base))
+    nclist = existing_files(conn, locations)
+    return [r for r in rqlist
+            if not all(os.path.basename(path) in nclist for path in request_outputs(r))]
+
+
+def fetch(r, res):
+    """ Download the file of completed request r and check its structure,
+        a file failing the check is removed and downloaded again up to
+        cfg['verify_retry'] times
+        Return the checksum of the downloaded file or None if it failed
+    """
+    metrics = get_metrics(cfg)
+    tempfn = r[2]
+    fn = r[3]
+    # get size from response to check file complete
+    size = res.content_length
+    for attempt in range(cfg.get('verify_retry', 1) + 1):
+        # file could have been downloaded already by an interrupted run
+        if download_complete(tempfn, size):
+            era5log.info(f'Already downloaded {tempfn}')
+            checksum = file_checksum(tempfn, new_digest(cfg))
+        else:
+            # get download url and replace host with the fastest one
+            # wait for a download slot and space in staging
+            digest = new_digest(cfg)
+            with get_governor(cfg).slot(size, era5log, tempfn) as ok:
+                if not ok:
+                    metrics.inc('downloads_failed', job=fn)
+                    return None
+                mirrors = get_mirrors(cfg)
+                host, url = mirrors.choose(res.location)
+                era5log.debug(f'Downloading from host {host}: {url}')
+                # only the bytes transferred now count for the host rate
+                fetched = size - downloaded_bytes(tempfn, size)
+                start = time.time()
+                downloaded = False
+                try:
+                    downloaded = file_down(url, tempfn, size, era5log, digest)
+                finally:
+                    # the host is released also if the download raised
+                    mirrors.record(host, fetched, time.time() - start, downloaded)
+                metrics.observe('download', time.time() - start, fn)
+            if not downloaded:
+                metrics.inc('downloads_failed', job=fn)
+                return None
+            metrics.inc('bytes_downloaded', size, job=fn)
+            checksum = digest.hexdigest()
+        with metrics.timer('verify', fn):
+            error = check_file(tempfn)
+        if error is None:
+            era5log.debug(f'{cfg.get("checksum", "md5")} {checksum} {tempfn}')
+            return checksum
+        era5log.warning(f'Corrupted download {tempfn}: {error}')
+        metrics.inc('verify_errors', job=fn)
+        for path in [tempfn, tempfn + '.ranges']:
+            if os.path.exists(path):
+                os.remove(path)
+    return None
+
+
+def do_request(r, res):
+    """
+    Download a completed request. param 'r' is a tuple:
     [0] dataset name
     [1] the query
     [2] file staging path
     [3] file target path
-    [4] ip for download url
+    [4] ip for download url, not used, the host is chosen by the mirror selector
     [5] userid
+    [6] list of (variable, target path) if the request is for more than one variable
+    param 'res' is the cdsapi Result returned by the scheduler
 
-    Download to staging area first, compress netcdf (nccopy)
+    Download to staging area first, check file is complete, compress netcdf (nccopy)
+    Job state is updated after each step and output files are added to the catalogue
     """
+    jobs = get_jobs(cfg)
+    metrics = get_metrics(cfg)
     tempfn = r[2]
     fn = r[3]
-  
-    # the actual retrieve part
-    # set api key explicitly so you can alternate
-    with open(f'/mnt/pvol/era5/.cdsapirc{r[5]}', 'r') as f:
-        credentials = yaml.safe_load(f)
-    # create client instance
-    c = cdsapi.Client(url=credentials['url'], key=credentials['key'], verify=1)
-    era5log.info(f'Requesting {tempfn} ... ')
-    era5log.info(f'Request: {r[1]}')
-    # need to capture exceptions
-    apirc = False
+    if not jobs.owns(fn):
+        era5log.warning(f'Not downloading {tempfn}, job was taken over by another worker')
+        return
+    for path in [tempfn, fn] + [vfn for var, vfn in r[6]]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    checksum = fetch(r, res)
+    if checksum is None:
+        jobs.update(fn, 'failed')
+        return
+    jobs.update(fn, 'downloaded', checksum=checksum)
+    # remote request is not needed anymore
     try:
-        # issue the request (to modified api)
-        res = c.retrieve(r[0], r[1], tempfn)
-        apirc = True
+        res.delete()
     except Exception as e:
-        era5log.error(f'ERROR: {e}')
-        apirc = False
-    # if request successful download file
-    if apirc:
-        # get download url and replace ip
-        url = res.location
-        # get size from response to check file complete
-        size = res.content_length
-        # check for slow IPs
-        for ip in cfg['slowips']:
-            if f'.{ip}/' in res.location:
-                url = res.location.replace(f'.{ip}/', f'.{r[4]}/')
-        if file_down(url, tempfn, size, era5log):            # successful
-            # if netcdf compress file, assuming it'll fail if file is corrupted
-            # if tgz  untar, if zip unzip
-            # if grib skip
-            if tempfn[-3:] == '.nc':
-                era5log.info(f'Compressing {tempfn} ...')
-                cmd = f"{cfg['nccmd']} {tempfn} {fn}"
-            elif tempfn[-4:] == '.tgz':
-                era5log.info(f'Untarring and concatenating {tempfn} ...')
-                base = os.path.dirname(tempfn) 
-                cmd =  f"{cfg['untar']} {tempfn} -C {base}; {cfg['concat']} {base}/*.nc {fn[:-4]}.nc; rm {base}/*.nc"
-            elif tempfn[-4:] == '.zip':
-                era5log.info(f'Unzipping and concatenating {tempfn} ...')
-                base = os.path.dirname(tempfn) 
-                cmd =  f"unzip {tempfn} -d {base}; {cfg['concat']} {base}/*.nc {fn[:-4]}.nc; rm {base}/*.nc"
-            else:
-                cmd = "echo 'nothing to do'"
-            era5log.debug(f"{cmd}")
-            p = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
-            out,err = p.communicate()
-            era5log.debug(f"Popen out/err: {out}, {err}")
-            if not p.returncode:       # check was successful
-                era5log.info(f'ERA5 download success: {fn}')
-            else:
-                era5log.info(f'ERA5 nc command failed! (deleting compressed file {fn})\n{err.decode()}')
+        era5log.warning(f'Could not delete request for {tempfn}: {e}')
+    outputs = request_outputs(r)
+    jobs.expect(fn, outputs)
+    if r[6]:
+        # split coalesced request in a compressed file for each variable
+        from era5.era5_compress import submit_compress
+        for var, vfn in r[6]:
+            era5log.info(f'Extracting {var} from {tempfn} ...')
+            submit_compress(tempfn, vfn, cfg, era5log, varlist=[var],
+                            callback=lambda path, checksum: file_done(r, path, outputs, checksum), job=fn)
+        return
+    # if netcdf compress file, assuming it'll fail if file is corrupted
+    # if tgz or zip extract and concatenate in a temporary directory for this file
+    # if grib or compression is disabled move file to its destination
+    native = cfg.get('compress') == 'native' and have_netcdf4()
+    if tempfn[-5:] == '.grib' or (tempfn[-3:] == '.nc' and cfg.get('compress') == 'none'):
+        with metrics.timer('place', fn):
+            try:
+                method = place_file(tempfn, fn)
+            except OSError as e:
+                era5log.error(f'ERROR: cannot move {tempfn} to {fn}: {e}')
+                jobs.file_failed(fn, fn)
+                return
+        era5log.info(f'ERA5 download success: {fn} ({method})')
+        # content is unchanged, the download checksum is still valid
+        file_done(r, fn, outputs, checksum)
+        return
+    if tempfn[-4:] in ['.tgz', '.zip']:
+        era5log.info(f'Extracting and concatenating {tempfn} ...')
+        from era5.era5_extract import submit_extract
+        submit_extract(tempfn, outputs[0], cfg, era5log, native,
+                       callback=lambda path, checksum: file_done(r, path, outputs, checksum), job=fn)
+        return
+    if tempfn[-3:] == '.nc' and native:
+        era5log.info(f'Compressing {tempfn} ...')
+        # compression runs in its own process pool, free this thread for next download
+        from era5.era5_compress import submit_compress
+        submit_compress(tempfn, fn, cfg, era5log,
+                        callback=lambda path, checksum: file_done(r, path, outputs, checksum), job=fn)
+        return
+    elif tempfn[-3:] == '.nc':
+        era5log.info(f'Compressing {tempfn} ...')
+        # written to a temporary name so a partial file is never in the data directory
+        cmd = f"{cfg['nccmd']} {tempfn} {fn}.tmp"
+    else:
+        era5log.error(f'ERROR: unknown format {tempfn}')
+        jobs.file_failed(fn, fn)
+        return
+    era5log.debug(f"{cmd}")
+    with metrics.timer('compress', fn):
+        p = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
+        out,err = p.communicate()
+    era5log.debug(f"Popen out/err: {out}, {err}")
+    if not p.returncode:       # check was successful
+        os.replace(f'{fn}.tmp', fn)
+        era5log.info(f'ERA5 download success: {fn}')
+        file_done(r, fn, outputs, file_checksum(fn, new_digest(cfg)))
+    else:
+        metrics.inc('compress_errors', job=fn)
+        jobs.file_failed(fn, fn)
+        era5log.info(f'ERA5 nc command failed! (deleting compressed file {fn})\n{err.decode()}')
+        if os.path.exists(f'{fn}.tmp'):
+            os.remove(f'{fn}.tmp')
     return
 
 
-def api_request(oformat, stream, params, yr, mntlist, tstep, back):
-    """ Build a list of CDSapi requests based on arguments
-        Call do_request to submit them and start parallel download
-        If download successful, compress file and move to era5/netcdf
+def build_requests(oformat, stream, params, yr, mntlist, tstep, back, coalesce=False):
+    """ Build a list of CDSapi requests based on arguments, skipping files
+        already in the database
+        If coalesce is True variables for the same dates are requested together
+        and the downloaded file is split in a file for each variable
     """
+    start = time.time()
     # open connection to era5 files db 
     conn = db_connect(cfg)
     # create empty list to  store cdsapi requests
     rqlist = []
-    # list of faster ips to alternate
-    ips = cfg['altips']
+    # list of download hosts, the one actually used is chosen at download
+    ips = cfg.get('mirrors', cfg.get('altips', ['']))
     users = cfg['users']
     i = 0 
     # list of years when ERA5.1 should be donwloaded instead of ERA5
@@ -149,53 +287,126 @@ def api_request(oformat, stream, params, yr, mntlist, tstep, back):
     # define params to download
     if params == []:
         params = dsargs['params']
+    # variables can be passed also by name
+    params = [grib_code(stream, p) or p for p in params]
     era5log.debug(f'Params: {params}')
+    # resolve variables once and get all the files already in db for the
+    # locations touched by this request with a single query
+    variables = {}
+    for varp in params:
+        queue, var, cdsname =  define_var(vardict, varp, era5log)
+        # if grib code exists but cds name is not defined skip var and print warning
+        if queue:
+            variables[varp] = (var, cdsname)
+    if tstep == 'mon':
+        locations = [f"{stream}/{var}/monthly" for var, cdsname in variables.values()]
+    else:
+        locations = [f"{stream}/{var}/{y}" for var, cdsname in variables.values() for y in yr]
+    nclist = existing_files(conn, locations)
+    era5log.debug(f'Files already in db: {len(nclist)}')
+    if coalesce and (oformat != 'netcdf' or back or stream not in ['surface','pressure','land','wave']):
+        era5log.info(f'Variables can be requested together only for hourly and monthly netcdf ERA5 files')
+        coalesce = False
+    if coalesce and not have_netcdf4():
+        era5log.info(f'netCDF4 is needed to split requests for multiple variables')
+        coalesce = False
+    # MARS requests for ERA5.1 always get all variables of a month together
+    # if the file can be split, otherwise one variable at the time
+    mars_split = oformat == 'netcdf' and not back and have_netcdf4()
+    # requests smaller than minbytes are merged if they can be split, requests
+    # over maxitems fields or maxbytes are split in fewer days
+    maxitems = cfg.get('maxitems', 120000)
+    maxbytes = cfg.get('maxbytes', 0)
+    minbytes = cfg.get('minbytes', 0) if mars_split and stream in ['surface','pressure','land','wave'] else 0
+
+    def request(dsargs, group, y, mn, mars):
+        """ Build request for the variables in group
+        """
+        if mars:
+            return build_mars(dsargs, y, mn, '/'.join(e[0] for e in group), oformat, tstep, back)
+        cdsname = [e[2] for e in group] if len(group) > 1 else group[0][2]
+        return build_dict(dsargs, y, mn, cdsname, group[0][6], oformat, tstep, back)
     
     # according to ECMWF, best to loop through years and months and do either multiple
     # variables in one request, or at least loop through variables in the innermost loop.
+    # MARS data is on tape in date order, requests are built in date order
+    # so consecutive requests read the same or the next tape file
     
-    for y in yr:
+    for y in sorted(yr):
         era5log.debug(f'Year: {y}')
         # change dsid if pressure and year between 2000 and 2006 included
-        mars = False
-        if y in era51 and stream == 'pressure':
+        mars = y in era51 and stream == 'pressure'
+        if mars:
             era5log.debug(f'Submitting using mars for ERA5.1')
-            mars = True
-            dsargs = define_args(stream+"51", tstep)
-            dsargs['dsid'] = 'reanalysis-era5.1-complete'
+            ydsargs = define_args(stream+"51", tstep)
+            ydsargs['dsid'] = 'reanalysis-era5.1-complete'
+        else:
+            ydsargs = dsargs
         # build Copernicus requests for each month and submit it using cdsapi modified module
-        for mn in mntlist:
+        for mn in sorted(mntlist):
             era5log.debug(f'Month: {mn}')
             # for each output file build request and append to list
             # loop through params and months requested
+            entries = []
+            costs = {}
             for varp in params:
                 era5log.debug(f'Param: {varp}')
-                queue, var, cdsname =  define_var(vardict, varp, era5log)
-                # if grib code exists but cds name is not defined skip var and print warning
-                if not queue:
+                if varp not in variables:
                     continue
-                # create list of filenames already existing for this var and yr
-                nclist = []
-                sql = "select filename from file where location=?" 
-                tup = (f"{stream}/{var}/{y}",)
-                if tstep == 'mon':
-                    tup = (f"{stream}/{var}/monthly",)
-                nclist += query(conn, sql, tup)
-                era5log.debug(nclist)
-
+                var, cdsname = variables[varp]
                 stagedir, destdir, fname, daylist = target(stream, var,
-                                    y, mn, dsargs, tstep, back, oformat)
+                                    y, mn, ydsargs, tstep, back, oformat)
                 # if file already exists in datadir then skip
                 if file_exists(fname, nclist):
                     era5log.info(f'Skipping {fname} already exists')
                     continue
-                if mars:
-                    rdict = build_mars(dsargs, y, mn, varp, oformat, tstep, back)
-                else:
-                    rdict = build_dict(dsargs, y, mn, cdsname, daylist, oformat, tstep, back)
-                rqlist.append((dsargs['dsid'], rdict, os.path.join(stagedir,fname),
+                entry = (varp, var, cdsname, stagedir, destdir, fname, daylist)
+                cost = estimate(ydsargs['dsid'], request(ydsargs, [entry], y, mn, mars))
+                n = nparts(cost, maxitems, maxbytes)
+                if n == 1 or mars or tstep != 'hr' or stream == 'wfde5':
+                    entries.append(entry)
+                    costs[fname] = cost
+                    continue
+                # split hourly file in files for fewer days, named by their first and last day
+                era5log.info(f'Splitting {fname} in {n} requests: {cost["fields"]} fields, {cost["bytes"]} bytes')
+                for days in split_days(daylist, n):
+                    pname = fname.replace(f'{y}{mn}{daylist[0]}_{y}{mn}{daylist[-1]}',
+                                          f'{y}{mn}{days[0]}_{y}{mn}{days[-1]}')
+                    if file_exists(pname, nclist):
+                        era5log.info(f'Skipping {pname} already exists')
+                        continue
+                    entry = (varp, var, cdsname, stagedir, destdir, pname, days)
+                    entries.append(entry)
+                    costs[pname] = estimate(ydsargs['dsid'], request(ydsargs, [entry], y, mn, mars))
+            # one request for as many variables as allowed by CDS fields limit
+            # MARS variables are in parameter order as stored for each date
+            if mars:
+                entries.sort(key=lambda e: tuple(int(x) for x in e[0].split('.')))
+            if mars and mars_split or coalesce:
+                merge = entries
+            else:
+                merge = [e for e in entries if costs[e[5]]['bytes'] < minbytes]
+            groups = [[e] for e in entries if e not in merge]
+            # only files for the same days can be merged
+            for days in dict.fromkeys(tuple(e[6]) for e in merge):
+                same = [e for e in merge if tuple(e[6]) == days]
+                groups.extend(group_vars(same, [costs[e[5]] for e in same], maxitems,
+                                         0 if mars else maxbytes))
+            for group in groups:
+                varp, var, cdsname, stagedir, destdir, fname, daylist = group[0]
+                splits = []
+                if len(group) > 1:
+                    cdsname = [e[2] for e in group]
+                    splits = [(e[1], os.path.join(e[4], e[5])) for e in group]
+                    # merged file name: hash of variables list and dates from first file
+                    tag = hashlib.md5(','.join(cdsname).encode()).hexdigest()[:8]
+                    stagedir = os.path.join(cfg['staging'], stream, 'merged',
+                                            os.path.basename(stagedir))
+                    fname = tag + fname[len(var):]
+                rdict = request(ydsargs, group, y, mn, mars)
+                rqlist.append((ydsargs['dsid'], rdict, os.path.join(stagedir,fname),
                            os.path.join(destdir, fname), ips[i % len(ips)],
-                           users[i % len(users)])) 
+                           users[i % len(users)], splits)) 
                 # progress index to alternate between ips and users
                 i+=1
                 era5log.info(f'Added request for {fname}')
@@ -204,32 +415,105 @@ def api_request(oformat, stream, params, yr, mntlist, tstep, back):
                 break
     
     era5log.debug(f'{rqlist}')
-    # parallel downloads
+    get_metrics(cfg).observe('plan', time.time() - start)
+    return rqlist
+
+
+def api_request(oformat, stream, params, yr, mntlist, tstep, back, coalesce=False):
+    """ Build a list of CDSapi requests based on arguments
+        Pass them to the scheduler to submit them and start parallel download
+        If download successful, compress file and move to era5/netcdf
+    """
+    rqlist = build_requests(oformat, stream, params, yr, mntlist, tstep, back, coalesce)
+    # set num of threads = number of params, or use default from config
+    if params == []:
+        params = define_args(stream, tstep)['params']
+    if len(params) > 1:
+        nthreads = len(params)
+    else:
+        nthreads = cfg['nthreads']
+    run_requests(rqlist, nthreads)
+
+
+def run_requests(rqlist, nthreads):
+    """ Pass the requests to the scheduler to submit them and download
+        them in parallel as they complete
+    """
     if len(rqlist) > 0:
-        # set num of threads = number of params, or use default from config
-        if len(params) > 1:
-            nthreads = len(params)
-        else:
-            nthreads = cfg['nthreads']
-        pool = ThreadPool(nthreads)
-        results = pool.imap(do_request, rqlist)
-        pool.close()
-        pool.join()
+        from era5.era5_scheduler import Scheduler
+        from era5.era5_compress import wait_compress
+        scheduler = Scheduler(cfg, era5log, do_request, nthreads)
+        scheduler.run(rqlist)
+        wait_compress()
+        get_metrics(cfg).write()
     else:
         era5log.info('No files to download!')
     era5log.info('--- Done ---')
 
 
+def plan_request(oformat, stream, params, yr, mntlist, tstep, back, coalesce=False):
+    """ Return the plan of the requests to download based on arguments,
+        nothing is submitted or written
+    """
+    from era5.era5_plan import make_plan
+    args = {'format': oformat, 'stream': stream, 'params': params, 'year': yr,
+            'months': mntlist, 'timestep': tstep, 'back': back, 'coalesce': coalesce}
+    rqlist = build_requests(oformat, stream, params, yr, mntlist, tstep, back, coalesce)
+    return make_plan(rqlist, args)
+
+
+def profile_imports():
+    """ Time the imports done after startup, only the outermost import
+        is timed so each module time includes the modules it imports
+        Return dictionary {module: seconds} filled as modules are imported
+    """
+    times = {}
+    depth = [0]
+    real_import = builtins.__import__
+
+    def timed_import(name, *args, **kwargs):
+        outer = depth[0] == 0 and name not in sys.modules
+        depth[0] += 1
+        t0 = time.perf_counter()
+        try:
+            return real_import(name, *args, **kwargs)
+        finally:
+            depth[0] -= 1
+            if outer:
+                times[name] = times.get(name, 0) + time.perf_counter() - t0
+
+    builtins.__import__ = timed_import
+    return times
+
+
+def report_startup(times, start):
+    """ Print import times breakdown to stderr
+    """
+    click.echo(f'Startup imports (cli module): {_imported - _start:.3f}s', err=True)
+    for name, t in sorted(times.items(), key=lambda x: -x[1]):
+        click.echo(f'  {name}: {t:.3f}s', err=True)
+    click.echo(f'Lazy imports total: {sum(times.values()):.3f}s', err=True)
+    click.echo(f'Command total: {time.perf_counter() - start:.3f}s', err=True)
+
+
 @click.group()
 @click.option('--debug', is_flag=True, default=False,
                help="Show debug info")
-def era5(debug):
+@click.option('--profile-startup', is_flag=True, default=False,
+               help="Report time spent importing modules")
+@click.pass_context
+def era5(ctx, debug, profile_startup):
     """
     Request and download ERA5 data from the climate copernicus
     server using the cdsapi module.
     """
     global era5log 
-    era5log = config_log(debug)
+    if profile_startup:
+        start = time.perf_counter()
+        times = profile_imports()
+        ctx.call_on_close(lambda: report_startup(times, start))
+    # bench uses its own temporary configuration
+    era5log = config_log(debug, logfile=ctx.invoked_subcommand != 'bench')
 
 
 def common_args(f):
@@ -254,7 +538,7 @@ def download_args(f):
                      help="ECMWF stream currently operative analysis surface, pressure levels, "+\
                      "wave model, ERA5 land, CESM_Fire, AgERA5, WFDE5"),
         click.option('--param', '-p', multiple=True,
-             help="Grib code parameter for selected variable, pass as param.table i.e. 132.128. If not passed all parameters in <stream_tstep>.json will be downloaded"),
+             help="Grib code parameter for selected variable, pass as param.table i.e. 132.128, or variable name i.e. t. If not passed all parameters in <stream_tstep>.json will be downloaded"),
         click.option('--year', '-y', multiple=True, required=True,
                      help="year to download"),
         click.option('--queue', '-q', is_flag=True, default=False,
@@ -262,7 +546,9 @@ def download_args(f):
         click.option('--back', '-b', is_flag=True, default=False,
                      help="Request backwards all years and months as one file, works only for monthly or daily data"),
         click.option('--urgent', '-u', is_flag=True, default=False,
-                     help="high priority request, default False, if specified request is saved in Urgent folder which is pick first by wrapper. Works only for queued requests.")
+                     help="high priority request, default False, if specified request is saved in Urgent folder which is pick first by wrapper or serve. Works only for queued requests."),
+        click.option('--coalesce', is_flag=True, default=False,
+                     help="Request variables for the same month together and split the downloaded file by variable, works only for ERA5 netcdf files")
     ]
     for c in reversed(constraints):
         f = c(f)
@@ -288,10 +574,26 @@ def db_args(f):
     return f
 
 
+def print_plan(plan):
+    """ Print the estimated fields and size of each request in plan and the total
+    """
+    for r in plan['requests']:
+        nvars = max(1, len(r['splits']))
+        click.echo(f"{os.path.basename(r['target'])}  {r['dsid']}  {nvars} var  "
+                   + f"{r['fields']} fields  {r['bytes'] / 1048576:.1f} MB")
+    total = plan['total']
+    click.echo(f"{total['requests']} requests  {total['fields']} fields  "
+               + f"{total['bytes'] / 1048576:.1f} MB")
+
+
 @era5.command()
 @common_args
 @download_args
-def download(oformat, param, stream, year, month, timestep, back, queue, urgent):
+@click.option('--dry-run', is_flag=True, default=False,
+              help="Print the requests that would be submitted with their estimated size")
+@click.option('--plan', 'planfile', default=None,
+              help="Write the requests that would be submitted as a json plan to this file, - for stdout")
+def download(oformat, param, stream, year, month, timestep, back, queue, urgent, coalesce, dry_run, planfile):
     """ 
     Download ERA5 variables, to be preferred 
     if adding a new variable,
@@ -310,24 +612,144 @@ def download(oformat, param, stream, year, month, timestep, back, queue, urgent)
     if (oformat,stream) not in valid_format:
         print(f'Download format {oformat} not available for {stream} product')
         sys.exit()
-    if queue:
-        dump_args(oformat, stream, list(param), list(year), list(month), timestep, back, urgent)
+    if dry_run or planfile:
+        plan = plan_request(oformat, stream, list(param), list(year), list(month),
+                            timestep, back, coalesce)
+        if planfile:
+            from era5.era5_plan import write_plan
+            write_plan(plan, planfile)
+        else:
+            print_plan(plan)
+    elif queue:
+        dump_args(oformat, stream, list(param), list(year), list(month), timestep, back, urgent, coalesce)
     else:    
-        api_request(oformat, stream, list(param), list(year), list(month), timestep, back)
+        api_request(oformat, stream, list(param), list(year), list(month), timestep, back, coalesce)
 
 
 @era5.command()
 @click.option('--file', '-f', 'infile', default='/g/data/ub4/Work/Requests/requests.json',
              help="Pass json file with list of requests, instead of arguments")
-def scan(infile):
+@click.option('--plan', 'planfile', default=None,
+              help="Write the requests that would be submitted as a json plan to this file, - for stdout")
+def scan(infile, planfile):
     """ 
     Load arguments from file instead of separately
     """
     with open(infile, 'r') as fj:
          args = json.load(fj)
+    if planfile:
+        from era5.era5_plan import write_plan
+        write_plan(plan_request(args['format'], args['stream'],
+                   args['params'], args['year'], args['months'],
+                   args['timestep'], args['back'], args.get('coalesce', False)), planfile)
+        return
     api_request( args['format'], args['stream'], 
                 args['params'], args['year'], args['months'], 
-                args['timestep'], args['back'])
+                args['timestep'], args['back'], args.get('coalesce', False))
+
+
+@era5.command()
+@click.argument('planfile')
+@click.option('--shard', default=None,
+              help="Run only a shard of the plan as index/count, i.e. 0/4 runs requests 0, 4, 8 ...")
+@click.option('--enqueue', is_flag=True, default=False,
+              help="Add the requests to the job table for 'era5 worker' processes instead of running them")
+def execute(planfile, shard, enqueue):
+    """ 
+    Submit and download the requests of a plan written with --plan
+    """
+    from era5.era5_plan import read_plan, parse_shard
+    rqlist = read_plan(planfile, parse_shard(shard) if shard else None)
+    # files catalogued after the plan was written are skipped
+    todo = not_catalogued(rqlist)
+    era5log.info(f'Plan {planfile}: {len(rqlist)} requests, {len(rqlist) - len(todo)} already catalogued')
+    if enqueue:
+        get_jobs(cfg).enqueue(todo)
+        era5log.info(f'Queued {len(todo)} requests for the workers')
+    else:
+        run_requests(todo, cfg['nthreads'])
+
+
+@era5.command()
+@click.option('--wait', is_flag=True, default=False,
+              help="Keep waiting for new jobs when the queue is empty")
+def worker(wait):
+    """ 
+    Claim and run jobs queued with 'execute --enqueue', any number of
+    workers on hosts sharing the database can run at the same time
+    """
+    from era5.era5_worker import Worker
+    from era5.era5_compress import wait_compress
+    w = Worker(cfg, era5log, do_request, cfg['nthreads'], wait)
+    w.run()
+    wait_compress()
+    w.release()
+
+
+@era5.command()
+def serve():
+    """ 
+    Run as a daemon processing the requests queued with 'download -q'
+    as soon as they are saved, urgent requests first
+    """
+    from era5.era5_serve import Server
+    from era5.era5_compress import wait_compress
+    server = Server(cfg, era5log, do_request, build_requests, cfg['nthreads'])
+    server.serve()
+    wait_compress()
+    server.write_metrics()
+    era5log.info('--- Done ---')
+
+
+def parse_range(value):
+    """ Parse 'min,max' or a single value to a tuple of floats
+
+        >>> parse_range('1,5')
+        (1.0, 5.0)
+        >>> parse_range('2')
+        (2.0, 2.0)
+    """
+    values = [float(v) for v in value.split(',')]
+    return (values[0], values[-1])
+
+
+@era5.command()
+@click.option('--vars', 'nvars', default=4, help="Number of variables to request")
+@click.option('--months', 'nmonths', default=2, help="Number of months to request")
+@click.option('--size', default=10.0, help="Size of each file in MB")
+@click.option('--queue-delay', default='1,5', help="Min,max seconds a request is queued")
+@click.option('--run-delay', default='1,5', help="Min,max seconds a request runs")
+@click.option('--fail-rate', default=0.0, help="Fraction of requests failing")
+@click.option('--hosts', default='1:0', 
+              help="Download hosts and their rate in bytes/s (0 no limit) as host:rate,host:rate")
+@click.option('--users', 'nusers', default=3, help="Number of CDS accounts")
+@click.option('--threads', 'nthreads', default=4, help="Number of download threads")
+@click.option('--seed', default=0, help="Random seed for the mock server")
+@click.option('--workdir', default=None, help="Directory for the benchmark files, default temporary")
+@click.option('--json', 'as_json', is_flag=True, default=False, help="Print results as json")
+def bench(nvars, nmonths, size, queue_delay, run_delay, fail_rate, hosts, nusers,
+          nthreads, seed, workdir, as_json):
+    """ 
+    Run the whole download pipeline against a local mock CDS server
+    and report throughput and latency, config.json is not used
+    """
+    from era5.era5_bench import run_bench
+    hosts = {h: float(r) for h, r in (x.split(':') for x in hosts.split(','))}
+    res = run_bench(api_request, cfg, nvars, nmonths, int(size * 1048576),
+                    parse_range(queue_delay), parse_range(run_delay), fail_rate,
+                    hosts, nusers, nthreads, seed, workdir)
+    if as_json:
+        click.echo(json.dumps(res, indent=1))
+        return
+    click.echo(f"Files: {res['files']}, jobs: {res['jobs']}, catalogued: {res['catalogued']}")
+    click.echo(f"Elapsed: {res['elapsed']:.1f}s, downloaded: {res['bytes']/1048576:.1f} MB, "
+               + f"throughput: {res['throughput']/1048576:.2f} MB/s, "
+               + f"{res['files_per_hour']:.0f} files/hour")
+    for phase, lat in res['latency'].items():
+        click.echo(f"  {phase:10s} p50 {lat['p50']:8.2f}s  p90 {lat['p90']:8.2f}s  max {lat['max']:8.2f}s")
+    click.echo(f"Counters: {res['counters']}")
+    click.echo(f"Server: {res['server']}")
+    click.echo(f"Files in {res['workdir']}")
 
 
 @era5.command()
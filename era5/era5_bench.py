@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Benchmark of the whole download pipeline (plan, submit, download, compress,
+# catalogue) against the mock CDS server, run by 'era5 bench'
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import math
+import os
+import tempfile
+import time
+from era5.era5_db import db_connect, create_table, query
+from era5.era5_metadata import stream_args
+from era5.era5_metrics import get_metrics
+from era5.era5_mock import MockCDS
+
+
+def bench_config(workdir, mock, users, nthreads):
+    """ Return a configuration using directories in workdir and the
+        mock server for all users
+    """
+    for d in ['staging', 'netcdf', 'derived', 'log', 'Requests']:
+        os.makedirs(os.path.join(workdir, d), exist_ok=True)
+    for u in users:
+        with open(os.path.join(workdir, f'cdsapirc{u}'), 'w') as f:
+            f.write(f'url: {mock.url}\nkey: 1:bench\n')
+    return {'nthreads': nthreads, 'maxjobs': 4, 'maxitems': 120000,
+            'poll_interval': 0.5, 'cdsapirc': os.path.join(workdir, 'cdsapirc'),
+            'datadir': os.path.join(workdir, 'netcdf'),
+            'derivdir': os.path.join(workdir, 'derived'),
+            'staging': os.path.join(workdir, 'staging'),
+            'logdir': os.path.join(workdir, 'log'),
+            'requestdir': os.path.join(workdir, 'Requests/'),
+            'metrics': os.path.join(workdir, 'log', 'metrics.json'),
+            'tracefile': os.path.join(workdir, 'log', 'trace.jsonl'),
+            'db': os.path.join(workdir, 'era5.sqlite'),
+            'downloader': 'native', 'segments': 4, 'min_segment': 1048576,
+            'chunk_size': 1048576, 'timeout': 60, 'retry': 3,
+            'compress': 'native', 'ncompress': 2, 'deflate': 1, 'shuffle': True,
+            'chunks': {}, 'nccmd': 'cp', 'concat': 'cp',
+            'getcmd': 'curl -s -o', 'resumecmd': 'curl -s -C - -o',
+            'mirrors': sorted(mock.hosts), 'users': users,
+            'ncrawl': 4, 'batch': 1000}
+
+
+def percentile(values, p):
+    """ Return percentile p of values (nearest rank), 0 if empty
+
+        >>> percentile([4, 1, 3, 2], 50)
+        2
+        >>> percentile([4, 1, 3, 2], 90)
+        4
+    """
+    if not values:
+        return 0
+    return sorted(values)[max(0, math.ceil(p * len(values) / 100) - 1)]
+
+
+def run_bench(api_request, cfg, nvars=4, nmonths=2, size=10485760,
+              queue_delay=(1, 5), run_delay=(1, 5), fail_rate=0.0,
+              hosts={'1': 0}, nusers=3, nthreads=4, seed=0, workdir=None):
+    """ Run api_request for nvars surface hourly variables and nmonths
+        against a mock CDS server, using a temporary configuration.
+        Return a dictionary with throughput, latency of each phase and
+        the mock server statistics
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='era5_bench_')
+    mock = MockCDS(queue_delay, run_delay, fail_rate, size, hosts, seed).start()
+    users = [str(u) for u in range(1, nusers + 1)]
+    cfg.use(bench_config(workdir, mock, users, nthreads))
+    conn = db_connect(cfg)
+    create_table(conn, cfg)
+    params = stream_args('surface', 'hr')['params'][:nvars]
+    months = [f'{m:02d}' for m in range(1, nmonths + 1)]
+    start = time.time()
+    try:
+        api_request('netcdf', 'surface', params, ['2001'], months, 'hr', False)
+    finally:
+        mock.stop()
+    elapsed = time.time() - start
+    metrics = get_metrics(cfg).to_dict()
+    c = conn.cursor()
+    c.execute('SELECT state, COUNT(*) FROM job GROUP BY state')
+    states = dict(c.fetchall())
+    catalogued = query(conn, 'SELECT COUNT(*) FROM file', ())[0]
+    traces = metrics['finished']
+    latency = {}
+    for phase in ['queue', 'run', 'download', 'compress', 'catalogue']:
+        values = [t[phase] for t in traces if phase in t]
+        latency[phase] = {'p50': percentile(values, 50), 'p90': percentile(values, 90),
+                          'max': max(values) if values else 0}
+    downloaded = metrics['counters'].get('bytes_downloaded', 0)
+    return {'workdir': workdir, 'files': nvars * nmonths, 'elapsed': elapsed,
+            'jobs': states, 'catalogued': catalogued,
+            'bytes': downloaded, 'throughput': downloaded / elapsed if elapsed else 0,
+            'files_per_hour': states.get('catalogued', 0) * 3600 / elapsed if elapsed else 0,
+            'latency': latency, 'phases': metrics['phases'],
+            'counters': metrics['counters'], 'server': mock.stats}
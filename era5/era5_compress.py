@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In-process netcdf compression, used instead of nccopy when netCDF4 is available.
+# Variables are copied block by block so a file is never fully loaded in memory,
+# files are compressed in a process pool independent from the download threads
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product as iproduct
+from era5.era5_jobs import get_jobs
+from era5.era5_metrics import get_metrics
+from era5.era5_verify import file_checksum
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def have_netcdf4():
+    """ Check netCDF4 is installed without importing it
+    """
+    return importlib.util.find_spec('netCDF4') is not None
+
+
+def chunk_shape(dims, shape, chunks):
+    """ Return chunk sizes for a variable, using the size in chunks for
+        each dimension name, or the full dimension length if not defined
+
+        >>> chunk_shape(('time', 'latitude', 'longitude'), (744, 721, 1440),
+        ...             {'time': 744, 'latitude': 32})
+        [744, 32, 1440]
+    """
+    return [max(1, min(chunks.get(d, n), n)) for d, n in zip(dims, shape)]
+
+
+def blocks(shape, chunksizes):
+    """ Yield the slices of each block to copy, blocks are aligned to chunks
+        along all dimensions but the last one which is copied in full
+
+        >>> list(blocks((3, 4), [2, 2]))
+        [(slice(0, 2, None), slice(0, 4, None)), (slice(2, 3, None), slice(0, 4, None))]
+    """
+    ranges = [range(0, n, c) for n, c in zip(shape[:-1], chunksizes[:-1])]
+    for starts in iproduct(*ranges):
+        yield tuple([slice(s, min(s + c, n)) for s, c, n in
+                     zip(starts, chunksizes, shape)] + [slice(0, shape[-1])])
+
+
+def compress_nc(src, dst, level=5, shuffle=True, chunks=None, varlist=None, checksum=None):
+    """ Copy src netcdf file to dst as netcdf4 with deflate compression,
+        dst is written to a temporary name and renamed when complete
+        If varlist is passed copy only these variables and the coordinates
+        If checksum is passed, compute checksum of dst with this algorithm
+        Return a dictionary with input and output size, ratio, elapsed time and checksum
+    """
+    import netCDF4
+    start = time.time()
+    chunks = chunks or {}
+    tmpfn = dst + '.tmp'
+    with netCDF4.Dataset(src, 'r') as fin, netCDF4.Dataset(tmpfn, 'w', format='NETCDF4') as fout:
+        fin.set_auto_maskandscale(False)
+        missing = [v for v in (varlist or []) if v not in fin.variables]
+        if missing:
+            raise Exception(f'Variables {missing} not in {src}')
+        fout.setncatts({k: fin.getncattr(k) for k in fin.ncattrs()})
+        for name, dim in fin.dimensions.items():
+            fout.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, var in fin.variables.items():
+            if varlist is not None and name not in varlist and name not in fin.dimensions:
+                continue
+            fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            if var.ndim == 0:
+                vout = fout.createVariable(name, var.dtype, (), fill_value=fill)
+            else:
+                chunksizes = chunk_shape(var.dimensions, var.shape, chunks)
+                vout = fout.createVariable(name, var.dtype, var.dimensions,
+                       zlib=True, complevel=level, shuffle=shuffle,
+                       chunksizes=chunksizes, fill_value=fill)
+            vout.set_auto_maskandscale(False)
+            vout.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            if var.ndim == 0:
+                vout.assignValue(var.getValue())
+            elif var.size > 0:
+                for block in blocks(var.shape, chunksizes):
+                    vout[block] = var[block]
+    os.replace(tmpfn, dst)
+    insize = os.path.getsize(src)
+    outsize = os.path.getsize(dst)
+    digest = None
+    if checksum is not None:
+        digest = file_checksum(dst, hashlib.new(checksum))
+    return {'file': dst, 'insize': insize, 'outsize': outsize,
+            'ratio': insize / outsize if outsize else 0,
+            'elapsed': time.time() - start, 'checksum': digest}
+
+
+def get_pool(cfg):
+    """ Return the compression process pool, its size cfg['ncompress'] is
+        independent from the number of download threads
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=cfg.get('ncompress', 2),
+                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def pool_callback(src, dst, cfg, era5log, callback=None, job=None):
+    """ Return the function called when the pool has processed src to dst,
+        compression ratio and time are logged and callback is called with
+        dst and its checksum if successful.
+        Compression time is added to the metrics of job, dst by default.
+    """
+    def done(fut):
+        try:
+            stats = fut.result()
+            era5log.info(f"ERA5 download success: {dst}")
+            era5log.info(f"Compressed {src}: ratio {stats['ratio']:.2f}, {stats['elapsed']:.1f}s")
+            get_metrics(cfg).observe('compress', stats['elapsed'], job or dst)
+            if callback is not None:
+                callback(dst, stats['checksum'])
+        except Exception as e:
+            era5log.info(f'ERA5 compression failed! {dst}\n{e}')
+            get_metrics(cfg).inc('compress_errors', job=job or dst)
+            if job is not None:
+                get_jobs(cfg).file_failed(job, dst)
+            if os.path.exists(dst + '.tmp'):
+                os.remove(dst + '.tmp')
+
+    return done
+
+
+def submit_compress(src, dst, cfg, era5log, varlist=None, callback=None, job=None):
+    """ Submit src to the compression pool, callback is called with dst
+        and its checksum if successful.
+        Return the future
+    """
+    fut = get_pool(cfg).submit(compress_nc, src, dst, cfg.get('deflate', 5),
+                               cfg.get('shuffle', True), cfg.get('chunks', {}), varlist,
+                               cfg.get('checksum', 'md5'))
+    fut.add_done_callback(pool_callback(src, dst, cfg, era5log, callback, job))
+    return fut
+
+
+def wait_compress():
+    """ Wait for all submitted files to be compressed and close the pool
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Estimate of the number of fields and bytes of a request, used to split
+# requests over the CDS limits and merge small ones before submitting them
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import math
+from datetime import date
+
+
+# grid resolution in degrees of each dataset, when it can't be found from area
+resolutions = {'reanalysis-era5-land': 0.1,
+               'sis-agrometeorological-indicators': 0.1,
+               'derived-near-surface-meteorological-variables': 0.5}
+# CDS netcdf and grib files store values as 16 bits integers
+value_bytes = 2
+
+
+def as_list(value):
+    """ Return a request value as a list, strings can be separated by /
+
+        >>> as_list('1/2/3')
+        ['1', '2', '3']
+        >>> as_list(['01', '02'])
+        ['01', '02']
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.split('/')
+    return list(value)
+
+
+def resolution(dsid, area):
+    """ Return grid resolution of dataset dsid, for global areas this is the
+        distance of the east bound from 180
+
+        >>> resolution('reanalysis-era5-single-levels', '90/-180/-90/179.5')
+        0.5
+        >>> resolution('reanalysis-era5-pressure-levels', '20/78/-57/-140')
+        0.25
+    """
+    north, west, south, east = [float(x) for x in as_list(area)]
+    if west == -180 and 0 < 180 - east <= 1:
+        return round(180 - east, 3)
+    for prefix, res in resolutions.items():
+        if dsid.startswith(prefix):
+            return res
+    return 0.25
+
+
+def grid_points(dsid, area):
+    """ Return number of grid points in area N/W/S/E, which can cross
+        the date line
+
+        >>> grid_points('reanalysis-era5-pressure-levels', '20/78/-57/-140')
+        175821
+    """
+    north, west, south, east = [float(x) for x in as_list(area)]
+    res = resolution(dsid, area)
+    nlat = round((north - south) / res) + 1
+    nlon = round(((east - west) % 360) / res) + 1
+    return nlat * nlon
+
+
+def mars_days(datestr):
+    """ Return number of dates in a MARS date string
+
+        >>> mars_days('2001-02-01/to/2001-02-28')
+        28
+        >>> mars_days('20010101/20010201')
+        2
+    """
+    dates = as_list(datestr)
+    if len(dates) == 3 and dates[1] == 'to':
+        start, end = [date.fromisoformat(d) for d in (dates[0], dates[2])]
+        return (end - start).days + 1
+    return len(dates)
+
+
+def request_fields(rdict):
+    """ Return number of fields (variable, level, time) requested by a CDS
+        or MARS request
+
+        >>> request_fields({'variable': ['t', 'u'], 'pressure_level': ['1000', '850'],
+        ...                 'year': '2001', 'month': '01', 'day': ['01', '02'],
+        ...                 'time': ['00:00', '12:00']})
+        16
+    """
+    nvars = len(as_list(rdict.get('variable', rdict.get('param'))))
+    nlevels = len(as_list(rdict.get('pressure_level', rdict.get('levelist')))) or 1
+    ntimes = len(as_list(rdict.get('time'))) or 1
+    if 'date' in rdict:
+        ndates = mars_days(rdict['date'])
+    else:
+        ndates = (max(1, len(as_list(rdict.get('day'))))
+                  * max(1, len(as_list(rdict.get('month'))))
+                  * max(1, len(as_list(rdict.get('year')))))
+    return max(1, nvars) * nlevels * ntimes * ndates
+
+
+def estimate(dsid, rdict):
+    """ Return estimated fields and bytes of request rdict for dataset dsid
+    """
+    fields = request_fields(rdict)
+    return {'fields': fields,
+            'bytes': fields * grid_points(dsid, rdict['area']) * value_bytes}
+
+
+def nparts(cost, maxitems, maxbytes=0):
+    """ Return in how many parts a request must be split to be within
+        maxitems fields and maxbytes bytes (0 no limit)
+
+        >>> nparts({'fields': 250, 'bytes': 100}, 100)
+        3
+        >>> nparts({'fields': 10, 'bytes': 100}, 100, 40)
+        3
+    """
+    n = math.ceil(cost['fields'] / maxitems)
+    if maxbytes:
+        n = max(n, math.ceil(cost['bytes'] / maxbytes))
+    return max(1, n)
+
+
+def split_days(daylist, n):
+    """ Split daylist in n consecutive parts of about the same length
+
+        >>> split_days(['01', '02', '03', '04', '05'], 2)
+        [['01', '02', '03'], ['04', '05']]
+    """
+    n = min(n, len(daylist))
+    size = math.ceil(len(daylist) / n)
+    return [daylist[k:k+size] for k in range(0, len(daylist), size)]
+
+
+def group_vars(entries, costs, maxitems, maxbytes=0):
+    """ Split list of variables in groups requesting at most maxitems fields
+        and maxbytes bytes (0 no limit), costs are the estimates of each variable
+
+        >>> group_vars(['a', 'b', 'c'], [{'fields': 10, 'bytes': 5}] * 3, 25)
+        [['a', 'b'], ['c']]
+        >>> group_vars(['a', 'b', 'c'], [{'fields': 10, 'bytes': 5}] * 3, 100, 15)
+        [['a', 'b', 'c']]
+    """
+    groups = []
+    fields = nbytes = 0
+    for e, cost in zip(entries, costs):
+        if (groups and fields + cost['fields'] <= maxitems
+                and (not maxbytes or nbytes + cost['bytes'] <= maxbytes)):
+            groups[-1].append(e)
+            fields += cost['fields']
+            nbytes += cost['bytes']
+        else:
+            groups.append([e])
+            fields, nbytes = cost['fields'], cost['bytes']
+    return groups
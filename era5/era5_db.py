@@ -19,31 +19,135 @@
 # contact: paolap@utas.edu.au
 # last updated 28/04/2020
 
+import logging
 import os
+import re
 import sqlite3
+import threading
 from datetime import datetime
+from fnmatch import fnmatch
+from functools import partial
 from glob import glob
 from itertools import repeat
+from multiprocessing.dummy import Pool as ThreadPool
 from era5.era5_functions import define_args, read_vars
 import sys
 
 
-def db_connect(cfg):
-    """ connect to ERA5 files sqlite db
+def db_connect(cfg, check_same_thread=True):
+    """ connect to ERA5 files sqlite db, cfg['journal_mode'] if set overrides
+        the WAL journal, WAL can't be used if the db is shared between hosts
     """
-    return sqlite3.connect(cfg['db'], timeout=10, isolation_level=None)
+    conn = sqlite3.connect(cfg['db'], timeout=cfg.get('db_timeout', 10), isolation_level=None,
+                           check_same_thread=check_same_thread)
+    mode = cfg.get('journal_mode')
+    if mode and conn.execute('PRAGMA journal_mode').fetchone()[0].lower() != mode.lower():
+        try:
+            conn.execute(f'PRAGMA journal_mode={mode}')
+        except sqlite3.OperationalError as e:
+            # the mode can't change while other connections are open
+            logging.getLogger('era5log').warning(f"Cannot set journal_mode {mode} on {cfg['db']}: {e}")
+    return conn
 
 
-def create_table(conn):
-    """ create file table if database doesn't exists or empty
+# parse grid, first date and optional timestep from the end of a filename
+fname_re = re.compile(r'_(?:(?P<tstep>hr|day|mon)_)?(?P<grid>[^_]+)_(?P<start>\d{6,8})(?:_\d{6,8})?\.\w+$')
+
+
+def parse_filename(filename, location):
+    """ Return stream, variable, year, month, grid and timestep of a file
+        from its name and location, unknown values are None
+
+        >>> parse_filename('t2m_era5_global_20200101_20200131.nc', 'surface/t2m/2020')
+        ('surface', 't2m', '2020', '01', 'global', 'hr')
+        >>> parse_filename('z_era5_mon_global_197901_201912.nc', 'pressure/z/monthly')
+        ('pressure', 'z', '1979', '01', 'global', 'mon')
+    """
+    parts = location.split('/')
+    stream = parts[0]
+    var = parts[1] if len(parts) > 1 else None
+    m = fname_re.search(filename)
+    if m is None:
+        return (stream, var, None, None, None, None)
+    start = m.group('start')
+    return (stream, var, start[:4], start[4:6], m.group('grid'), m.group('tstep') or 'hr')
+
+
+def schema_v1(c):
+    """ Original tables: files and directories mtime from last crawl
+    """
+    c.execute('CREATE TABLE IF NOT EXISTS file( filename TEXT PRIMARY KEY, location TEXT, ncidate TEXT, size INT);')
+    c.execute('CREATE TABLE IF NOT EXISTS dir( path TEXT PRIMARY KEY, mtime INT);')
+
+
+def schema_v2(c):
+    """ Add columns parsed from filename and location, and indexes to select files
+    """
+    for col in ['stream', 'variable', 'year', 'month', 'grid', 'timestep']:
+        c.execute(f'ALTER TABLE file ADD COLUMN {col} TEXT')
+    c.execute('SELECT rowid, filename, location FROM file')
+    rows = [parse_filename(fn, l) + (rowid,) for rowid, fn, l in c.fetchall()]
+    c.executemany('UPDATE file SET stream=?, variable=?, year=?, month=?, grid=?, timestep=? WHERE rowid=?', rows)
+    c.execute('CREATE INDEX IF NOT EXISTS file_location ON file(location, filename)')
+    c.execute('CREATE INDEX IF NOT EXISTS file_var ON file(stream, variable, timestep, year, month)')
+
+
+def schema_v3(c):
+    """ Add job table to keep track of each download request state
+    """
+    c.execute('CREATE TABLE IF NOT EXISTS job( target TEXT PRIMARY KEY, dsid TEXT, request TEXT,'
+              + ' staging TEXT, ip TEXT, user TEXT, splits TEXT, state TEXT, request_id TEXT,'
+              + ' location TEXT, size INT, updated TEXT);')
+    c.execute('CREATE INDEX IF NOT EXISTS job_state ON job(state)')
+
+
+def schema_v4(c):
+    """ Add checksum of downloaded file to job table and of catalogued file to file table
+    """
+    c.execute('ALTER TABLE job ADD COLUMN checksum TEXT')
+    c.execute('ALTER TABLE file ADD COLUMN checksum TEXT')
+
+
+def schema_v5(c):
+    """ Add owner and lease expiry time of jobs run by workers sharing the job table,
+        and worker table with the last heartbeat of each worker
+    """
+    c.execute('ALTER TABLE job ADD COLUMN owner TEXT')
+    c.execute('ALTER TABLE job ADD COLUMN lease REAL')
+    c.execute('CREATE INDEX IF NOT EXISTS job_owner ON job(owner)')
+    c.execute('CREATE TABLE IF NOT EXISTS worker( id TEXT PRIMARY KEY, host TEXT, pid INT,'
+              + ' started TEXT, heartbeat TEXT, jobs INT);')
+
+
+# each function upgrades the schema by one version, the db version is stored in user_version
+migrations = [schema_v1, schema_v2, schema_v3, schema_v4, schema_v5]
+
+
+def create_table(conn, cfg=None):
+    """ create tables if database doesn't exists or empty,
+        or upgrade the schema of an existing database to the latest version
         :conn  connection object
+        :cfg   configuration, new databases use WAL unless cfg['journal_mode'] is set
     """
-    file_sql = 'CREATE TABLE IF NOT EXISTS file( filename TEXT PRIMARY KEY, location TEXT, ncidate TEXT, size INT);' 
-    try:
-        c = conn.cursor()
-        c.execute(file_sql)
-    except Error as e:
-        print(e)
+    c = conn.cursor()
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    new = c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='file'").fetchone() is None
+    # WAL is persistent, set only on new databases, existing ones may be shared between hosts
+    if new and not (cfg or {}).get('journal_mode'):
+        try:
+            c.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.OperationalError as e:
+            logging.getLogger('era5log').warning(f'Cannot set WAL journal: {e}')
+    for n, migration in enumerate(migrations[version:], start=version+1):
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            migration(c)
+            c.execute(f'PRAGMA user_version={n}')
+            c.execute('COMMIT')
+        except sqlite3.Error as e:
+            c.execute('ROLLBACK')
+            print(e)
+            raise
 
 
 def query(conn, sql, tup):
@@ -55,20 +159,99 @@ def query(conn, sql, tup):
         return [ x[0] for x in c.fetchall() ]
 
 
-def crawl(g, xl, basedir):
-    """ Crawl base directory for all netcdf files
+def existing_files(conn, locations):
+    """ Return set of filenames already in db for a list of locations
+    """
+    nclist = set()
+    locations = list(set(locations))
+    # keep number of sql variables below sqlite limit
+    for n in range(0, len(locations), 500):
+        chunk = locations[n:n+500]
+        sql = f"SELECT filename FROM file WHERE location IN ({','.join('?'*len(chunk))})"
+        nclist.update(query(conn, sql, tuple(chunk)))
+    return nclist
+
+
+def catalogue_file(conn, path, basedir, checksum=None):
+    """ Add a single file to the file table, or update it if the file
+        was downloaded again, return number of rows changed
     """
-    # get stats for all files not in db yet
     tsfmt = '%FT%T'
+    s = os.stat(path)
+    d, fn = os.path.split(path)
+    l = os.path.relpath(d, basedir)
+    ts = datetime.fromtimestamp(s.st_mtime).strftime(tsfmt)
+    c = conn.cursor()
+    sql = ('INSERT INTO file (filename, location, ncidate, size, stream, variable,'
+           + ' year, month, grid, timestep, checksum) values (?,?,?,?,?,?,?,?,?,?,?)'
+           + ' ON CONFLICT(filename) DO UPDATE SET location=excluded.location,'
+           + ' ncidate=excluded.ncidate, size=excluded.size, checksum=excluded.checksum')
+    c.execute(sql, (fn, l, ts, s.st_size) + parse_filename(fn, l) + (checksum,))
+    return c.rowcount
+
+
+def crawl(conn, d, basedir):
+    """ Crawl directory d for netcdf files not in db yet
+        If d mtime didn't change since last crawl the directory is skipped
+        Return list of file stats and directory mtime, mtime is None if skipped
+    """
+    tsfmt = '%FT%T'
+    mtime = os.stat(d).st_mtime_ns
+    if query(conn, 'SELECT mtime FROM dir WHERE path=?', (d,)) == [mtime]:
+        return [], None
+    l = os.path.relpath(d, basedir)
+    xl = set(query(conn, 'SELECT filename FROM file WHERE location=?', (l,)))
     file_list = []
-    for f in g:
-        dn, fn = os.path.split(f)
-        if not fn in xl:
-            s = os.stat(f)
-            l = dn.replace(basedir + '/', '')
-            ts = datetime.fromtimestamp(s.st_mtime).strftime(tsfmt)
-            file_list.append( (fn, l, ts, s.st_size) )
-    return file_list
+    # scandir returns file type with the names, stat only new files
+    with os.scandir(d) as it:
+        for entry in it:
+            if entry.name.endswith('.nc') and entry.name not in xl and entry.is_file():
+                s = entry.stat()
+                ts = datetime.fromtimestamp(s.st_mtime).strftime(tsfmt)
+                file_list.append( (entry.name, l, ts, s.st_size) + parse_filename(entry.name, l) )
+    return file_list, mtime
+
+
+def subdirs(pattern, d):
+    """ List sub-directories of d matching pattern
+    """
+    try:
+        with os.scandir(d) as it:
+            return [e.path for e in it if e.is_dir() and fnmatch(e.name, pattern)
+                    and not e.name.startswith('.')]
+    except FileNotFoundError:
+        return []
+
+
+def list_dirs(pool, basedir, match):
+    """ List all directories matching location pattern for given base dir
+        each level of the pattern is expanded listing directories in parallel
+    """
+    fsmatch = match.replace("____", "????")
+    fsmatch = fsmatch.replace("%", "*")
+    dirs = [basedir]
+    for part in fsmatch.split('/'):
+        dirs = [d for sub in pool.map(partial(subdirs, part), dirs) for d in sub]
+    return dirs
+
+
+def insert_files(conn, stats_list, mtimes):
+    """ Insert a batch of files and the mtime of their directories in one transaction
+        Return number of new rows
+    """
+    c = conn.cursor()
+    c.execute('BEGIN')
+    try:
+        sql = ('INSERT OR IGNORE INTO file (filename, location, ncidate, size,'
+               + ' stream, variable, year, month, grid, timestep) values (?,?,?,?,?,?,?,?,?,?)')
+        c.executemany(sql, stats_list)
+        nrows = c.rowcount
+        c.executemany('INSERT OR REPLACE INTO dir (path, mtime) values (?,?)', mtimes)
+        c.execute('COMMIT')
+    except:
+        c.execute('ROLLBACK')
+        raise
+    return nrows
 
 
 def set_query(st, var, tstep, yr='____', mn='%'):
@@ -86,6 +269,25 @@ def set_query(st, var, tstep, yr='____', mn='%'):
     return fname, location
 
 
+def set_filter(st, var, tstep, yr='%', mn='%'):
+    """ Set up sql conditions and values to select files using the parsed columns,
+        '%' selects any value
+
+        >>> set_filter('surface', 't2m', 'hr', '2020')
+        ('stream=? AND variable=? AND timestep=? AND year=?', ('surface', 't2m', 'hr', '2020'))
+    """
+    cols = ['stream', 'variable']
+    values = [st, var]
+    # derived products timestep is fixed by the stream
+    if st not in ['wfde5','cems_fire','agera5']:
+        cols.append('timestep')
+        values.append(tstep)
+    cols.extend(['year', 'month'])
+    values.extend([yr, mn])
+    sel = [(c, v) for c, v in zip(cols, values) if v != '%']
+    return ' AND '.join(f'{c}=?' for c, v in sel), tuple(v for c, v in sel)
+
+
 def get_basedir(cfg, stream):
     """ Return base directory base don stream
     """
@@ -142,7 +344,7 @@ def exp_files(stream, tstep):
     return nfiles
 
 
-def compare(conn, basedir, match, var, nfiles):
+def compare(conn, basedir, match, st, var, tstep, nfiles):
     """
     """
     # get a list of matching files on filesystem
@@ -157,50 +359,66 @@ def compare(conn, basedir, match, var, nfiles):
     else:
         print(f'{total-nfiles} extra files than expected for {var}\n')
     # get a list of matching files in db
-    sql = f"SELECT filename FROM file AS t WHERE t.location LIKE '{match}' ORDER BY filename ASC"
-    xl = query(conn, sql, ())
+    where, tup = set_filter(st, var, tstep)
+    sql = f"SELECT filename FROM file WHERE {where} ORDER BY filename ASC"
+    xl = query(conn, sql, tup)
     print(f'Records already in db: {len(xl)}')
 
 
 def update_db(cfg, stream, tstep, var):
     # read configuration and open ERA5 files database
     conn = db_connect(cfg)
-    create_table(conn)
+    create_table(conn, cfg)
+    # directories are listed and crawled in parallel, each thread has its own db connection
+    pool = ThreadPool(cfg.get('ncrawl', 16))
+    local = threading.local()
+
+    def crawl_dir(args):
+        d, basedir = args
+        if not hasattr(local, 'conn'):
+            local.conn = db_connect(cfg)
+        return (d,) + crawl(local.conn, d, basedir)
 
-    # List all netcdf files in datadir and derivdir
+    # List all netcdf directories in datadir and derivdir
     if not stream:
-        sql = 'SELECT filename FROM FILE ORDER BY filename ASC'
-        fs_list = list_files(cfg['datadir'],'*/*/*')
-        fs_list2 = list_files(cfg['derivdir'],'*/*')
+        dirs = [(d, cfg['datadir']) for d in list_dirs(pool, cfg['datadir'], '*/*/*')]
+        dirs.extend([(d, cfg['derivdir']) for d in list_dirs(pool, cfg['derivdir'], '*/*')])
     else:
-        fs_list = []
+        dirs = []
         if not var:
             var=['%']
+        basedir = get_basedir(cfg, stream)
         for v in var:
             fname, location = set_query(stream, v, tstep)
-            basedir = get_basedir(cfg, stream)
-            sql = f"SELECT filename FROM file AS t WHERE t.location LIKE '{location}' ORDER BY filename ASC"
-            fs_list.extend(list_files(basedir, location))
+            dirs.extend([(d, basedir) for d in list_dirs(pool, basedir, location)])
+    print(f'Searching on filesystem: {len(dirs)} directories ...')
 
-    xl = query(conn, sql, ())
-    if not stream:
-        stats_list = crawl(fs_list, xl, cfg['datadir'])
-        stats_list.extend( crawl(fs_list2, xl, cfg['derivdir']))
-        fs_list.extend(fs_list2)
-    else:
-        stats_list = crawl(fs_list, xl, basedir)
-    print(f'Records already in db: {len(xl)}')
-    print(f'New files found: {len(fs_list)-len(xl)}')
-    # insert into db
-    if len(stats_list) > 0:
-        print('Updating db ...')
-        with conn:
-            c = conn.cursor()
-            sql = 'INSERT OR IGNORE INTO file (filename, location, ncidate, size) values (?,?,?,?)'
-            #debug(sql)
-            c.executemany(sql, stats_list)
-            c.execute('select total_changes()')
-            print('Rows modified:', c.fetchall()[0][0])
+    # crawl only directories changed since last update
+    # and insert new files in batches as directories are crawled
+    batch = cfg.get('batch', 1000)
+    stats_list = []
+    mtimes = []
+    nchanged = 0
+    nfiles = 0
+    nrows = 0
+    for d, file_list, mtime in pool.imap_unordered(crawl_dir, dirs):
+        if mtime is None:
+            continue
+        nchanged += 1
+        stats_list.extend(file_list)
+        mtimes.append((d, mtime))
+        if len(stats_list) >= batch:
+            nfiles += len(stats_list)
+            nrows += insert_files(conn, stats_list, mtimes)
+            stats_list = []
+            mtimes = []
+    pool.close()
+    pool.join()
+    nfiles += len(stats_list)
+    nrows += insert_files(conn, stats_list, mtimes)
+    print(f'Changed directories: {nchanged}')
+    print(f'New files found: {nfiles}')
+    print('Rows modified:', nrows)
     print('--- Done ---')
 
 
@@ -225,7 +443,7 @@ def variables_stats(cfg, stream, tstep, varlist=[]):
 
     for var in varlist:
         fname, location = set_query(stream, var, tstep)
-        compare(conn, basedir, location, var, nfiles)
+        compare(conn, basedir, location, stream, var, tstep, nfiles)
 
 
 def delete_record(cfg, st, var, yr, mn, tstep):
@@ -237,21 +455,19 @@ def delete_record(cfg, st, var, yr, mn, tstep):
     for v in var:
         for y in yr:
             for m in mn:
-                fname, location = set_query(st, v, tstep, y, m)
-                sql = f'SELECT filename FROM file WHERE file.location="{location}" AND file.filename LIKE "{fname}"'
-                print(sql)
-                xl = query(conn, sql, ())
+                where, tup = set_filter(st, v, tstep, y, m)
+                sql = f'SELECT filename FROM file WHERE {where}'
+                print(sql, tup)
+                xl = query(conn, sql, tup)
                 print(f'Selected records in db: {xl}')
     # Delete from db
                 if len(xl) > 0:
                     confirm = input('Confirm deletion from database: Y/N   ')
                     if confirm == 'Y':
                         print('Updating db ...')
-                        for fname in xl:
-                            with conn:
-                                c = conn.cursor()
-                                sql = f'DELETE from file where filename="{fname}" AND location="{location}"'
-                                c.execute(sql)
-                                c.execute('select total_changes()')
-                                print('Rows modified:', c.fetchall()[0][0])
+                        with conn:
+                            c = conn.cursor()
+                            sql = f'DELETE from file WHERE {where}'
+                            c.execute(sql, tup)
+                            print('Rows modified:', c.rowcount)
     return
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# In-process downloader: a file is split in byte ranges which are downloaded
+# in parallel and written directly in place, only missing ranges are
+# requested again when resuming a failed download
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from era5.cdsapi.api import bytes_to_string
+from era5.era5_governor import get_governor
+from era5.era5_metrics import get_metrics
+from era5.era5_verify import OrderedHash
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(cfg):
+    """ Return a requests session shared by all download threads
+        so connections to the download hosts are reused
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            npool = cfg['nthreads'] * cfg.get('segments', 4)
+            adapter = HTTPAdapter(pool_connections=npool, pool_maxsize=npool)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def split_ranges(size, nseg, minseg):
+    """ Split size bytes in at most nseg ranges of at least minseg bytes
+        Return a dictionary {start: end} with end inclusive
+
+        >>> split_ranges(10, 3, 1)
+        {0: 3, 4: 7, 8: 9}
+        >>> split_ranges(10, 3, 8)
+        {0: 9}
+    """
+    nseg = max(1, min(nseg, size // max(minseg, 1)))
+    step = max(1, -(-size // nseg))
+    return {start: min(start + step, size) - 1 for start in range(0, size, step)}
+
+
+def read_state(statefn, size):
+    """ Read the bytes already downloaded for each range from the state file
+        Return None if state file doesn't exist or belongs to a different download
+    """
+    try:
+        with open(statefn, 'r') as fj:
+            state = json.load(fj)
+    except (FileNotFoundError, ValueError):
+        return None
+    if state.get('size') != size:
+        return None
+    return {int(k): tuple(v) for k, v in state['ranges'].items()}
+
+
+def write_state(statefn, size, ranges):
+    """ Save the end and the bytes downloaded for each range to the state file,
+        written to a temporary name so a killed process never leaves it truncated
+    """
+    with open(statefn + '.tmp', 'w') as fj:
+        json.dump({'size': size, 'ranges': ranges}, fj)
+    os.replace(statefn + '.tmp', statefn)
+
+
+def state_saver(statefn, size, ranges, cfg):
+    """ Return a function saving the state file if cfg['state_interval']
+        seconds passed or cfg['state_bytes'] bytes were downloaded since it
+        was last saved, to call with the ranges lock held
+    """
+    interval = cfg.get('state_interval', 5)
+    step = cfg.get('state_bytes', 67108864)
+    last = [time.time(), sum(done for end, done in ranges.values())]
+
+    def save():
+        done = sum(d for e, d in ranges.values())
+        if time.time() - last[0] >= interval or done - last[1] >= step:
+            write_state(statefn, size, ranges)
+            last[:] = [time.time(), done]
+
+    return save
+
+
+def fetch_range(session, url, fd, start, ranges, lock, cfg, governor, hasher=None, save=None):
+    """ Download one byte range and write it in place with pwrite
+        ranges[start] = (end, done) is updated while bytes are written
+        the governor limits the total download rate, the hasher
+        checksums the file as it is written, save is called to save progress
+    """
+    end, done = ranges[start]
+    if start + done > end:
+        return
+    headers = {'Range': f'bytes={start+done}-{end}'}
+    r = session.get(url, headers=headers, stream=True, timeout=cfg.get('timeout', 60))
+    try:
+        r.raise_for_status()
+        # server ignored Range, accept it only if we asked for the whole file
+        if r.status_code != 206 and start + done != 0:
+            raise Exception(f'Server does not support byte ranges: {url}')
+        for chunk in r.iter_content(chunk_size=cfg.get('chunk_size', 1048576)):
+            if not chunk:
+                continue
+            chunk = chunk[:end + 1 - start - done]
+            os.pwrite(fd, chunk, start + done)
+            done += len(chunk)
+            governor.throttle(len(chunk))
+            with lock:
+                ranges[start] = (end, done)
+                if save is not None:
+                    save()
+            if hasher is not None:
+                hasher.update()
+            if start + done > end:
+                break
+    finally:
+        r.close()
+    if start + done <= end:
+        raise Exception(f'Range {start}-{end} incomplete: {done} bytes')
+
+
+def range_download(url, target, size, cfg, era5log, digest=None):
+    """ Download url to target splitting it in cfg['segments'] byte ranges
+        downloaded in parallel. Progress is saved in <target>.ranges while
+        downloading, if the download fails or the process is killed only
+        the missing bytes are requested again, up to cfg['retry'] times.
+        If digest is passed, it is updated with the file content while downloading
+        :return: success: true or false
+    """
+    statefn = target + '.ranges'
+    ranges = read_state(statefn, size)
+    if ranges is None or not os.path.exists(target):
+        ranges = {k: (v, 0) for k, v in split_ranges(size,
+                  cfg.get('segments', 4), cfg.get('min_segment', 67108864)).items()}
+        # preallocate file so ranges can be written in place,
+        # state is saved first so a preallocated file is never taken as complete
+        write_state(statefn, size, ranges)
+        with open(target, 'wb') as f:
+            f.truncate(size)
+    session = get_session(cfg)
+    governor = get_governor(cfg)
+    lock = threading.Lock()
+    start_time = time.time()
+    offset = sum(done for end, done in ranges.values())
+    fd = os.open(target, os.O_WRONLY)
+    hasher = OrderedHash(digest, target, ranges, lock) if digest is not None else None
+    save = state_saver(statefn, size, ranges, cfg)
+    n = 0
+    try:
+        while True:
+            missing = [s for s, (e, d) in ranges.items() if s + d <= e]
+            if not missing:
+                break
+            if n > cfg['retry']:
+                era5log.info(f'ERA5 download failed after {n} attempts: {url}')
+                return False
+            if n > 0:
+                era5log.info(f'ERA5 Resuming download {n}: {len(missing)} ranges of {url}')
+                get_metrics(cfg).inc('download_retries')
+            else:
+                era5log.info(f'ERA5 Downloading: {url} to {target} ({bytes_to_string(size)},'
+                             + f' {len(missing)} ranges)')
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                futures = [executor.submit(fetch_range, session, url, fd, s,
+                           ranges, lock, cfg, governor, hasher, save) for s in missing]
+            for fut in futures:
+                if fut.exception() is not None:
+                    era5log.info(f'ERA5 download error: {fut.exception()}')
+            with lock:
+                write_state(statefn, size, ranges)
+            n += 1
+        if hasher is not None:
+            hasher.update(wait=True)
+    finally:
+        os.close(fd)
+        if hasher is not None:
+            hasher.close()
+    if os.path.exists(statefn):
+        os.remove(statefn)
+    elapsed = time.time() - start_time
+    if elapsed:
+        era5log.info(f'Download rate {bytes_to_string((size - offset) / elapsed)}/s: {target}')
+    return True
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Extraction of the tgz/zip archives of the derived products (cems_fire, agera5,
+# wfde5) and concatenation of their netcdf files along time. Each archive is
+# extracted in its own temporary directory and processed in the compression pool
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess as sp
+import tarfile
+import tempfile
+import time
+import zipfile
+from era5.era5_compress import blocks, chunk_shape, get_pool, pool_callback
+from era5.era5_place import place_file
+from era5.era5_verify import file_checksum
+
+
+def member_name(name):
+    """ Return the file name to use for archive member name, or None
+        if the member is not a netcdf file
+
+        >>> member_name('2001/Temperature_20010101.nc')
+        'Temperature_20010101.nc'
+        >>> member_name('README.txt') is None
+        True
+    """
+    base = os.path.basename(name)
+    if not base.endswith('.nc') or base.startswith('.'):
+        return None
+    return base
+
+
+def extract_members(archive, workdir):
+    """ Extract the netcdf files of a tgz or zip archive to workdir, tar
+        archives are read as a stream, members are written with their
+        base name only. Return the sorted list of extracted files
+    """
+    files = []
+
+    def save(name, fobj):
+        path = os.path.join(workdir, name)
+        if os.path.exists(path):
+            raise Exception(f'File {name} is more than once in {archive}')
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(fobj, f, 4194304)
+        files.append(path)
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as z:
+            for info in z.infolist():
+                name = member_name(info.filename)
+                if name is not None and not info.is_dir():
+                    with z.open(info) as fobj:
+                        save(name, fobj)
+    else:
+        with tarfile.open(archive, 'r|*') as tar:
+            for info in tar:
+                name = member_name(info.name)
+                if name is not None and info.isfile():
+                    save(name, tar.extractfile(info))
+    if not files:
+        raise Exception(f'No netcdf files in {archive}')
+    return sorted(files)
+
+
+def record_dim(ds):
+    """ Return the name of the dimension to concatenate along, the unlimited
+        dimension or time
+    """
+    for name, dim in ds.dimensions.items():
+        if dim.isunlimited():
+            return name
+    if 'time' in ds.dimensions:
+        return 'time'
+    raise Exception(f'No time dimension to concatenate in {ds.filepath()}')
+
+
+def concat_nc(files, dst, level=5, shuffle=True, chunks=None):
+    """ Concatenate netcdf files along time to dst as compressed netcdf4 classic,
+        variables and attributes are taken from the first file, times are
+        converted to the units of the first file. Data is copied block by block
+    """
+    import netCDF4
+    chunks = chunks or {}
+    with netCDF4.Dataset(files[0], 'r') as first:
+        tdim = record_dim(first)
+    # read all headers first to know the total length
+    lengths = []
+    for fn in files:
+        with netCDF4.Dataset(fn, 'r') as ds:
+            lengths.append(len(ds.dimensions[tdim]))
+    with netCDF4.Dataset(files[0], 'r') as first, \
+         netCDF4.Dataset(dst, 'w', format='NETCDF4_CLASSIC') as fout:
+        first.set_auto_maskandscale(False)
+        fout.setncatts({k: first.getncattr(k) for k in first.ncattrs()})
+        for name, dim in first.dimensions.items():
+            fout.createDimension(name, None if name == tdim else len(dim))
+        tvars = {}
+        for name, var in first.variables.items():
+            fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            shape = [sum(lengths) if d == tdim else n for d, n in zip(var.dimensions, var.shape)]
+            if var.ndim == 0:
+                vout = fout.createVariable(name, var.dtype, (), fill_value=fill)
+            else:
+                vout = fout.createVariable(name, var.dtype, var.dimensions,
+                       zlib=True, complevel=level, shuffle=shuffle,
+                       chunksizes=chunk_shape(var.dimensions, shape, chunks), fill_value=fill)
+            vout.set_auto_maskandscale(False)
+            vout.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            if tdim in var.dimensions:
+                if var.dimensions[0] != tdim:
+                    raise Exception(f'Variable {name} has {tdim} not as first dimension')
+                tvars[name] = vout
+            elif var.ndim == 0:
+                vout.assignValue(var.getValue())
+            elif var.size > 0:
+                for block in blocks(var.shape, vout.chunking()):
+                    vout[block] = var[block]
+        tvar = first.variables.get(tdim)
+        units = getattr(tvar, 'units', None)
+        calendar = getattr(tvar, 'calendar', 'standard')
+        pos = 0
+        for fn, n in zip(files, lengths):
+            with netCDF4.Dataset(fn, 'r') as ds:
+                ds.set_auto_maskandscale(False)
+                for name, vout in tvars.items():
+                    var = ds.variables[name]
+                    if name == tdim and units and getattr(var, 'units', units) != units:
+                        dates = netCDF4.num2date(var[:], var.units, calendar)
+                        vout[pos:pos + n] = netCDF4.date2num(dates, units, calendar)
+                        continue
+                    for block in blocks(var.shape, vout.chunking()):
+                        vout[(slice(pos + block[0].start, pos + block[0].stop),) + block[1:]] = var[block]
+            pos += n
+
+
+def extract_concat(archive, dst, workdir, level=5, shuffle=True, chunks=None,
+                   concat=None, checksum=None):
+    """ Extract the netcdf files of archive in a new temporary directory in
+        workdir and concatenate them to dst, with concat_nc or the concat
+        command if passed. dst is written to a temporary name and renamed
+        when complete, the temporary directory is always removed.
+        Return a dictionary with number of files, input and output size,
+        elapsed time and checksum of dst
+    """
+    start = time.time()
+    tmpdir = tempfile.mkdtemp(dir=workdir, prefix=os.path.basename(archive) + '.')
+    tmpfn = os.path.join(tmpdir, os.path.basename(dst))
+    try:
+        files = extract_members(archive, tmpdir)
+        if concat:
+            cmd = f"{concat} {' '.join(shlex.quote(f) for f in files)} {shlex.quote(tmpfn)}"
+            p = sp.run(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
+            if p.returncode:
+                raise Exception(f'{cmd} failed: {p.stderr.decode()}')
+        else:
+            concat_nc(files, tmpfn, level, shuffle, chunks)
+        insize = sum(os.path.getsize(f) for f in files)
+        # staging and data directories can be on different file systems
+        place_file(tmpfn, dst)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    outsize = os.path.getsize(dst)
+    digest = None
+    if checksum is not None:
+        digest = file_checksum(dst, hashlib.new(checksum))
+    return {'file': dst, 'nfiles': len(files), 'insize': insize, 'outsize': outsize,
+            'ratio': insize / outsize if outsize else 0,
+            'elapsed': time.time() - start, 'checksum': digest}
+
+
+def submit_extract(src, dst, cfg, era5log, native=True, callback=None, job=None):
+    """ Submit archive src to the compression pool to be extracted and
+        concatenated to dst, in-process if native otherwise with cfg['concat'].
+        Callback is called with dst and its checksum if successful.
+        Return the future
+    """
+    fut = get_pool(cfg).submit(extract_concat, src, dst, os.path.dirname(src),
+                               cfg.get('deflate', 5), cfg.get('shuffle', True),
+                               cfg.get('chunks', {}), None if native else cfg['concat'],
+                               cfg.get('checksum', 'md5'))
+    fut.add_done_callback(pool_callback(src, dst, cfg, era5log, callback, job))
+    return fut
@@ -19,17 +19,21 @@
 # contact: paolap@utas.edu.au
 # last updated 22/07/2019
 
+import getpass
 import logging
 import json
 import os
-import pkg_resources
+import stat
 import subprocess as sp
 from calendar import monthrange
+from collections.abc import Mapping
 from datetime import datetime
+from era5.era5_metadata import data_path, stream_args, stream_vars
 
 
-def config_log(debug):
-    ''' configure log file to keep track of users queries '''
+def config_log(debug, logfile=True):
+    ''' configure log file to keep track of users queries,
+        if logfile is False log only to console and don't read config.json '''
     # start a logger
     logger = logging.getLogger('era5log')
     # set a formatter to manage the output format of our handler
@@ -51,6 +55,8 @@ def config_log(debug):
         level = logging.WARNING
     clog.setLevel(level)
     logger.addHandler(clog)    
+    if not logfile:
+        return logger
 
     # add a handler to send INFO level messages to file 
     # the messages will be appended to the same file
@@ -76,7 +82,7 @@ def read_config():
     Read config from config.json file
     """
     try:
-        cfg_file = pkg_resources.resource_filename(__name__, 'data/config.json')
+        cfg_file = data_path('config.json')
         with open(cfg_file,'r') as fj:
             cfg = json.load(fj)
     except FileNotFoundError:
@@ -85,6 +91,33 @@ def read_config():
     return cfg
 
 
+class LazyConfig(Mapping):
+    """ Configuration dictionary, config.json is read only
+        the first time a value is requested
+    """
+    def __init__(self):
+        self._cfg = None
+
+    def _load(self):
+        if self._cfg is None:
+            self._cfg = read_config()
+        return self._cfg
+
+    def use(self, values):
+        """ Use dictionary values instead of config.json
+        """
+        self._cfg = values
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
 def define_dates(yr,mn):
     """ return a date range for each file depending on selected type """ 
     startday=1
@@ -110,22 +143,14 @@ def define_args(stream, tstep):
     ''' Return parameters and levels lists and step, time depending on stream type'''
     # this import the stream_dict dictionary <stream> : ['time','step','params','levels']
     # I'm getting the information which is common to all pressure/surface/wave variables form here, plus a list of the variables we download for each stream
-    stream_file = pkg_resources.resource_filename(__name__, f'data/era5_{stream}_{tstep}.json')
-    with open(stream_file, 'r') as fj:
-        dsargs = json.load(fj)
-    return  dsargs
+    # json files are read only once, a copy is returned so it can be modified
+    return stream_args(stream, tstep)
 
 
 def read_vars(stream):
     """Read parameters info from era5_vars.json file
     """
-    if stream in ['cems_fire', 'wfde5']:
-        var_file = pkg_resources.resource_filename(__name__, 'data/era5_derived.json')
-    else:
-        var_file = pkg_resources.resource_filename(__name__, 'data/era5_vars.json')
-    with open(var_file,'r') as fj:
-         vardict = json.load(fj)
-    return vardict 
+    return stream_vars(stream)
 
 
 def file_exists(fn, nclist):
@@ -196,9 +221,45 @@ def build_mars(dsargs, yr, mn, param, oformat, tstep, back):
     return rdict 
 
 
-def file_down(url, tempfn, size, era5log):
+def download_complete(tempfn, size):
+    """ Check if file was completely downloaded, an incomplete
+        parallel download has a .ranges file with its progress
+    """
+    return (os.path.exists(tempfn) and os.path.getsize(tempfn) == size
+            and not os.path.exists(tempfn + '.ranges'))
+
+
+def downloaded_bytes(tempfn, size):
+    """ Return bytes of tempfn already downloaded by an interrupted download
+    """
+    if not os.path.exists(tempfn):
+        return 0
+    if os.path.exists(tempfn + '.ranges'):
+        from era5.era5_download import read_state
+        ranges = read_state(tempfn + '.ranges', size)
+        return sum(done for end, done in ranges.values()) if ranges else 0
+    return min(os.path.getsize(tempfn), size)
+
+
+def file_down(url, tempfn, size, era5log, digest=None):
+    """ Download file in-process using parallel byte ranges,
+        or if cfg['downloader'] is 'cmd' open process to download file
+        If digest is passed it is updated with the file content
+        :return: success: true or false
+    """
+    if cfg.get('downloader', 'native') == 'native':
+        from era5.era5_download import range_download
+        return range_download(url, tempfn, size, cfg, era5log, digest)
+    downloaded = cmd_down(url, tempfn, size, era5log)
+    if downloaded and digest is not None:
+        from era5.era5_verify import file_checksum
+        file_checksum(tempfn, digest)
+    return downloaded
+
+
+def cmd_down(url, tempfn, size, era5log):
     """ Open process to download file
-        If fails try tor esume at least once
+        If fails try to resume at least once
         :return: success: true or false
     """
     cmd = f"{cfg['getcmd']} {tempfn} {url}"
@@ -213,6 +274,8 @@ def file_down(url, tempfn, size, era5log):
     while os.path.getsize(tempfn) < size and n < cfg['retry']:
         cmd = f"{cfg['resumecmd']} {tempfn} {url}"
         era5log.info(f'ERA5 Resuming download {n+1}: {url} to {tempfn}')
+        from era5.era5_metrics import get_metrics
+        get_metrics(cfg).inc('download_retries')
         p1 = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
         out,err = p1.communicate()
         # need to add something to break cycle if file unavailable or at least limits reruns
@@ -266,15 +329,11 @@ def target(stream, var, yr, mn, dsargs, tstep, back, oformat):
         destdir = os.path.join(cfg['derivdir'],stream,var)
     else:
         destdir = os.path.join(cfg['datadir'],stream,var,ydir)
-    # create path if required
-    if not os.path.exists(stagedir):
-            os.makedirs(stagedir)
-    if not os.path.exists(destdir):
-            os.makedirs(destdir)
+    # paths are created by do_request, so requests can be planned without side effects
     return stagedir, destdir, fname, daylist
 
 
-def dump_args(of, st, ps, yr, mns, tstep, back, urgent):
+def dump_args(of, st, ps, yr, mns, tstep, back, urgent, coalesce=False):
     """ Create arguments dictionary and dump to json file
     """
     tstamp = datetime.now().strftime("%Y%m%d%H%M%S") 
@@ -290,9 +349,11 @@ def dump_args(of, st, ps, yr, mns, tstep, back, urgent):
     args['months'] = mns
     args['timestep'] = tstep
     args['back'] = back
+    args['coalesce'] = coalesce
+    args['requester'] = getpass.getuser()
     with open(requestdir + fname, 'w+') as fj:
          json.dump(args, fj)
     return
 
 
-cfg = read_config()
+cfg = LazyConfig()
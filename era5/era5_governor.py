@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Limits shared by all downloads of a process: number of downloads running,
+# total download rate and free space left on the staging volume
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+class Governor(object):
+    """ Download threads wait for a slot before starting a download, a slot
+        is given when fewer than cfg['maxdownloads'] downloads are running
+        and the file fits on the staging volume leaving cfg['minfree'] bytes
+        free, counting the space still needed by the downloads running.
+        Only the bytes not on disk yet are reserved, so a partial file
+        resumed or a preallocated file being written is not counted twice.
+        The total rate of the in-process downloader is kept under
+        cfg['maxrate'] bytes/s, 0 means no limit.
+    """
+
+    def __init__(self, cfg):
+        self.maxdownloads = cfg.get('maxdownloads', cfg['nthreads'])
+        self.maxrate = cfg.get('maxrate', 0)
+        self.minfree = cfg.get('minfree', 0)
+        self.staging = cfg['staging']
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        # (path, size) of the downloads running
+        self.downloads = []
+        # token bucket for the download rate, allows bursts of one second
+        self.rate_lock = threading.Lock()
+        self.tokens = 0
+        self.last = time.monotonic()
+        # bytes downloaded in the last 10 seconds to measure the current rate
+        self.window = deque()
+
+    def missing(self, path, size):
+        """ Bytes of path still to be written to disk, files can be sparse
+            so allocated blocks are counted
+        """
+        try:
+            ondisk = os.stat(path).st_blocks * 512
+        except (OSError, TypeError):
+            ondisk = 0
+        return max(0, size - ondisk)
+
+    def reserved(self):
+        """ Bytes still needed by the downloads running
+        """
+        return sum(self.missing(path, size) for path, size in self.downloads)
+
+    def free(self):
+        """ Free bytes on the staging volume not reserved by running downloads
+        """
+        return shutil.disk_usage(self.staging).free - self.reserved()
+
+    def fits_disk(self, size, path=None):
+        return not self.minfree or self.free() - self.missing(path, size) >= self.minfree
+
+    def fits(self, size, path=None):
+        if self.active >= self.maxdownloads:
+            return False
+        return self.fits_disk(size, path)
+
+    @contextmanager
+    def slot(self, size, era5log, path=None):
+        """ Wait until a download of size bytes to path can start, the space
+            still missing is reserved until the download ends.
+            Yield False without waiting if the file can't fit in staging even
+            with no download running, True when the download can start
+        """
+        with self.cond:
+            if not self.fits(size, path):
+                self.waiting += 1
+                era5log.info(f'Download queued: {self.active} running, '
+                             + f'{self.free()} bytes free in staging')
+                # disk space is not notified, check it again every 30 seconds
+                while not self.fits(size, path):
+                    if self.active == 0 and not self.fits_disk(size, path):
+                        break
+                    self.cond.wait(30)
+                self.waiting -= 1
+            if not self.fits(size, path):
+                era5log.error(f'ERROR: {path} ({size} bytes) does not fit in staging, '
+                              + f'{self.free()} bytes free and minfree is {self.minfree}')
+                ok = False
+            else:
+                ok = True
+                self.active += 1
+                self.downloads.append((path, size))
+        if not ok:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.downloads.remove((path, size))
+                self.cond.notify_all()
+
+    def throttle(self, nbytes):
+        """ Account for nbytes downloaded, sleep if the total rate is over maxrate
+        """
+        now = time.monotonic()
+        delay = 0
+        with self.rate_lock:
+            self.window.append((now, nbytes))
+            while self.window[0][0] < now - 10:
+                self.window.popleft()
+            if self.maxrate:
+                self.tokens = min(self.maxrate, self.tokens + (now - self.last) * self.maxrate)
+                self.last = now
+                self.tokens -= nbytes
+                if self.tokens < 0:
+                    delay = -self.tokens / self.maxrate
+        if delay:
+            time.sleep(delay)
+
+    def rate(self):
+        """ Download rate in bytes/s over the last 10 seconds
+        """
+        now = time.monotonic()
+        with self.rate_lock:
+            return sum(n for t, n in self.window if t >= now - 10) / 10
+
+    def status(self):
+        """ Return current utilisation and limits as a dictionary
+        """
+        with self.cond:
+            return {'active': self.active, 'waiting': self.waiting,
+                    'maxdownloads': self.maxdownloads, 'reserved': self.reserved(),
+                    'free': self.free(), 'minfree': self.minfree,
+                    'rate': self.rate(), 'maxrate': self.maxrate}
+
+
+def get_governor(cfg):
+    """ Return the governor shared by all the threads of this process
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = Governor(cfg)
+    return _governor
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Persistent state of each download request, stored in the job table of the
+# era5 sqlite db, so an interrupted run can reattach to CDS requests already
+# submitted instead of queuing them again
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+from era5.era5_db import db_connect, create_table, catalogue_file
+from era5.era5_metrics import get_metrics
+
+
+# states of a job in the order they are reached, or failed
+states = ['planned', 'submitted', 'completed', 'downloaded', 'compressed', 'catalogued']
+# condition on jobs not finished
+unfinished = "state NOT IN ('catalogued', 'failed')"
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+class JobStore(object):
+    """ Read and update the job table, a job is identified by its target path.
+        The same connection is shared by the scheduler, the download threads
+        and the compression callbacks, access is serialised by a lock.
+        The job table is also the queue shared by workers, each job claimed
+        by a worker has an owner and a lease renewed by its heartbeat.
+        If owner is set, jobs taken over by another worker are not updated.
+    """
+
+    def __init__(self, cfg):
+        self.conn = db_connect(cfg, check_same_thread=False)
+        self.metrics = get_metrics(cfg)
+        self.lock = threading.Lock()
+        self.owner = None
+        # outputs of the jobs being compressed and which of them succeeded
+        self.outputs = {}
+        self.results = {}
+        with self.lock:
+            create_table(self.conn, cfg)
+
+    def execute(self, sql, tup=()):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(sql, tup)
+            return c.fetchall()
+
+    def plan(self, r):
+        """ Save a new request tuple as planned, a job already planned,
+            catalogued or failed is planned again, other jobs keep their state
+        """
+        now = datetime.now().strftime('%FT%T')
+        sql = ('INSERT INTO job (target, dsid, request, staging, ip, user, splits, state, updated)'
+               + ' VALUES (?,?,?,?,?,?,?,?,?) ON CONFLICT(target) DO UPDATE SET'
+               + ' request=excluded.request, state=excluded.state, request_id=NULL,'
+               + ' splits=excluded.splits, updated=excluded.updated WHERE job.state IN (?,?,?)')
+        self.execute(sql, (r[3], r[0], json.dumps(r[1]), r[2], r[4], r[5],
+                     json.dumps(r[6]), 'planned', now, 'planned', 'catalogued', 'failed'))
+
+    def enqueue(self, rqlist):
+        """ Add requests to the job table for the workers to claim, jobs
+            already planned, catalogued or failed are planned again without owner
+        """
+        now = datetime.now().strftime('%FT%T')
+        sql = ('INSERT INTO job (target, dsid, request, staging, ip, user, splits, state, updated)'
+               + ' VALUES (?,?,?,?,?,?,?,?,?) ON CONFLICT(target) DO UPDATE SET'
+               + ' request=excluded.request, state=excluded.state, request_id=NULL,'
+               + ' splits=excluded.splits, updated=excluded.updated, owner=NULL, lease=NULL'
+               + ' WHERE job.state IN (?,?,?)')
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            for r in rqlist:
+                c.execute(sql, (r[3], r[0], json.dumps(r[1]), r[2], r[4], r[5], json.dumps(r[6]),
+                                'planned', now, 'planned', 'catalogued', 'failed'))
+            c.execute('COMMIT')
+
+    def claim(self, owner, n, lease_time):
+        """ Take up to n unfinished jobs without owner or whose owner's lease
+            expired, in the order they were queued. The jobs are leased to
+            owner for lease_time seconds.
+            Return list of request tuples
+        """
+        now = time.time()
+        with self.lock:
+            c = self.conn.cursor()
+            # the write lock is taken before reading so two workers can't claim the same job
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                c.execute(f'SELECT * FROM job WHERE {unfinished} AND (owner IS NULL OR lease < ?)'
+                          + ' ORDER BY rowid LIMIT ?', (now, n))
+                cols = [d[0] for d in c.description]
+                jobs = [dict(zip(cols, row)) for row in c.fetchall()]
+                c.executemany('UPDATE job SET owner=?, lease=? WHERE target=?',
+                              [(owner, now + lease_time, job['target']) for job in jobs])
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+        return [(job['dsid'], json.loads(job['request']), job['staging'], job['target'],
+                 job['ip'], job['user'], [tuple(s) for s in json.loads(job['splits'])])
+                for job in jobs]
+
+    def renew(self, owner, lease_time):
+        """ Extend the lease of the unfinished jobs of owner and record
+            the worker heartbeat, return number of jobs owned
+        """
+        now = datetime.now().strftime('%FT%T')
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(f'UPDATE job SET lease=? WHERE owner=? AND {unfinished}',
+                      (time.time() + lease_time, owner))
+            n = c.rowcount
+            c.execute('INSERT INTO worker (id, host, pid, started, heartbeat, jobs) VALUES (?,?,?,?,?,?)'
+                      + ' ON CONFLICT(id) DO UPDATE SET heartbeat=excluded.heartbeat, jobs=excluded.jobs',
+                      (owner, socket.gethostname(), os.getpid(), now, now, n))
+        return n
+
+    def owned(self, owner):
+        """ Return number of unfinished jobs of owner
+        """
+        return self.execute(f'SELECT COUNT(*) FROM job WHERE owner=? AND {unfinished}', (owner,))[0][0]
+
+    def release(self, owner):
+        """ Remove owner from its unfinished jobs so other workers can claim them
+        """
+        self.execute(f'UPDATE job SET owner=NULL, lease=NULL WHERE owner=? AND {unfinished}', (owner,))
+
+    def ownership(self, targets):
+        """ Return {target: (owner, state)} for the jobs of targets
+        """
+        targets = list(targets)
+        if not targets:
+            return {}
+        rows = self.execute(f"SELECT target, owner, state FROM job WHERE target IN"
+                            + f" ({','.join('?' * len(targets))})", tuple(targets))
+        return {t: (o, s) for t, o, s in rows}
+
+    def owns(self, target):
+        """ Return False if the job was taken over by another worker
+        """
+        if self.owner is None:
+            return True
+        rows = self.execute('SELECT owner FROM job WHERE target=?', (target,))
+        return not rows or rows[0][0] in (None, self.owner)
+
+    def user_load(self):
+        """ Return number of requests queued or running on the server for each user,
+            for the workers sharing the job table. Only jobs with a valid lease are
+            counted, jobs left by interrupted runs or dead workers are not
+        """
+        return dict(self.execute('SELECT user, COUNT(*) FROM job WHERE state=? AND owner IS NOT NULL'
+                                 + ' AND lease >= ? GROUP BY user', ('submitted', time.time())))
+
+    def get(self, target):
+        """ Return job for target as a dictionary, None if not in table
+        """
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('SELECT * FROM job WHERE target=?', (target,))
+            row = c.fetchone()
+            if row is None:
+                return None
+            return dict(zip([d[0] for d in c.description], row))
+
+    def update(self, target, state, **cols):
+        """ Set state of job and optionally request_id, location, size and checksum,
+            a job owned by another worker is left as it is
+        """
+        cols['state'] = state
+        cols['updated'] = datetime.now().strftime('%FT%T')
+        sql = f"UPDATE job SET {', '.join(k+'=?' for k in cols)} WHERE target=?"
+        args = tuple(cols.values()) + (target,)
+        if self.owner is not None:
+            sql += ' AND (owner IS NULL OR owner=?)'
+            args += (self.owner,)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(sql, args)
+            updated = c.rowcount
+        if updated and state in ('catalogued', 'failed'):
+            self.metrics.finish(target, state)
+
+    def expect(self, target, outputs):
+        """ Set the output files of job, which is finished when each of them
+            is catalogued or failed
+        """
+        with self.lock:
+            self.outputs[target] = list(outputs)
+            self.results[target] = {}
+
+    def settle(self, target, path, ok):
+        """ Record if output path of job succeeded, the job is catalogued
+            when all its outputs exist and failed when all of them are
+            accounted for and any failed, a failed job is never changed back.
+            Return the new state of the job
+        """
+        with self.lock:
+            outputs = self.outputs.get(target, [path])
+            results = self.results.setdefault(target, {})
+            results[path] = ok
+            done = all(o in results or os.path.exists(o) for o in outputs)
+            if done:
+                self.outputs.pop(target, None)
+                self.results.pop(target, None)
+        job = self.get(target)
+        if job is not None and job['state'] == 'failed':
+            return 'failed'
+        if not done:
+            state = 'compressed'
+        elif all(results.get(o, True) for o in outputs) and all(os.path.exists(o) for o in outputs):
+            state = 'catalogued'
+        else:
+            state = 'failed'
+        self.update(target, state)
+        return state
+
+    def file_done(self, target, path, outputs, basedir, checksum=None):
+        """ Add output file path of job and its checksum to the catalogue,
+            the job is catalogued when all its output files are
+            Return True if the job is catalogued
+        """
+        with self.lock:
+            self.outputs.setdefault(target, list(outputs))
+            catalogue_file(self.conn, path, basedir, checksum)
+        return self.settle(target, path, True) == 'catalogued'
+
+    def file_failed(self, target, path):
+        """ Record that output file path of job could not be produced,
+            the job is failed once its other outputs are finished
+        """
+        self.settle(target, path, False)
+
+    def finished(self, targets):
+        """ Return True if all jobs for targets are catalogued or failed
+        """
+        for target in targets:
+            job = self.get(target)
+            if job is None or job['state'] not in ('catalogued', 'failed'):
+                return False
+        return True
+
+
+def get_jobs(cfg):
+    """ Return the job store shared by all the threads of this process
+    """
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = JobStore(cfg)
+    return _jobs
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Registry of the stream and variables json files in era5/data,
+# each file is read once when first needed and kept in memory
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import copy
+import json
+import os
+from functools import lru_cache
+
+try:
+    from importlib.resources import files
+except ImportError:
+    files = None
+
+
+def data_path(name):
+    """ Return path of file name in the package data directory
+    """
+    if files is not None:
+        return str(files('era5').joinpath('data', name))
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', name)
+
+
+@lru_cache(maxsize=None)
+def load_json(name):
+    """ Load json file name from the package data directory, only once
+    """
+    with open(data_path(name), 'r') as fj:
+        return json.load(fj)
+
+
+def stream_args(stream, tstep):
+    """ Return a copy of the stream arguments in era5_<stream>_<tstep>.json
+        the caller can modify it without changing the cached version
+    """
+    return copy.deepcopy(load_json(f'era5_{stream}_{tstep}.json'))
+
+
+def vars_file(stream):
+    """ Return name of json file with the variables for stream
+    """
+    if stream in ['cems_fire', 'wfde5']:
+        return 'era5_derived.json'
+    return 'era5_vars.json'
+
+
+def stream_vars(stream):
+    """ Return dictionary of variables for stream {grib code: [name, cds name]}
+    """
+    return dict(load_json(vars_file(stream)))
+
+
+@lru_cache(maxsize=None)
+def codes_index(name):
+    """ Inverse index of a variables json file {name: grib code}
+    """
+    return {v[0]: code for code, v in load_json(name).items()}
+
+
+def grib_code(stream, var):
+    """ Return grib code for variable name var in stream, None if not found
+    """
+    return codes_index(vars_file(stream)).get(var)
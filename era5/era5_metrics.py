@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Timing of each phase of the download pipeline and counters, written as
+# Prometheus text or json so the bottleneck (CDS queue, network, compression)
+# can be seen for each run
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+class Metrics(object):
+    """ Collect the time spent in each phase (plan, queue, run, download,
+        compress, catalogue), for all jobs and for each job, and counters
+        as bytes downloaded, retries and failures.
+        Metrics are written to cfg['metrics'] by write(), as json if the file
+        name ends with .json otherwise in the Prometheus text format, so it
+        can be read by the node exporter textfile collector.
+        The trace of each finished job is appended to cfg['tracefile'] as a
+        json line, if defined.
+    """
+
+    def __init__(self, cfg):
+        self.path = cfg.get('metrics')
+        self.tracefile = cfg.get('tracefile')
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # {phase: [count, total seconds, max seconds]}
+        self.timings = {}
+        self.counters = {}
+        # phases timing, bytes and retries of jobs in progress
+        self.traces = {}
+        self.finished = deque(maxlen=1000)
+
+    def observe(self, phase, seconds, job=None):
+        """ Add seconds spent in phase, to job trace too if job is passed
+        """
+        with self.lock:
+            t = self.timings.setdefault(phase, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+            if job is not None:
+                trace = self.traces.setdefault(job, {'job': job})
+                trace[phase] = trace.get(phase, 0) + seconds
+
+    @contextmanager
+    def timer(self, phase, job=None):
+        """ Time the code in the with block as phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start, job)
+
+    def inc(self, name, value=1, job=None):
+        """ Increase counter name by value, and the same field of job trace
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if job is not None:
+                trace = self.traces.setdefault(job, {'job': job})
+                trace[name] = trace.get(name, 0) + value
+
+    def finish(self, job, state):
+        """ Close the trace of job, state is its final state
+        """
+        with self.lock:
+            trace = self.traces.pop(job, {'job': job})
+            trace['state'] = state
+            trace['finished'] = time.strftime('%FT%T')
+            self.finished.append(trace)
+            if self.tracefile:
+                try:
+                    with open(self.tracefile, 'a') as f:
+                        f.write(json.dumps(trace) + '\n')
+                except OSError:
+                    pass
+
+    def to_dict(self):
+        with self.lock:
+            return {'uptime': time.time() - self.started,
+                    'phases': {p: {'count': t[0], 'seconds': t[1], 'max': t[2]}
+                               for p, t in self.timings.items()},
+                    'counters': dict(self.counters),
+                    'active': list(self.traces.values()),
+                    'finished': list(self.finished)}
+
+    def prometheus(self, gauges=None):
+        """ Return metrics in Prometheus text format, gauges is a dictionary
+            of current values to add, as {name: value}
+        """
+        gauges = gauges or {}
+        lines = ['# TYPE era5_phase_seconds summary']
+        with self.lock:
+            for p, (count, total, tmax) in sorted(self.timings.items()):
+                lines.append(f'era5_phase_seconds_count{{phase="{p}"}} {count}')
+                lines.append(f'era5_phase_seconds_sum{{phase="{p}"}} {total:.3f}')
+            lines.append('# TYPE era5_phase_seconds_max gauge')
+            for p, (count, total, tmax) in sorted(self.timings.items()):
+                lines.append(f'era5_phase_seconds_max{{phase="{p}"}} {tmax:.3f}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE era5_{name}_total counter')
+                lines.append(f'era5_{name}_total {value}')
+            lines.append('# TYPE era5_jobs_active gauge')
+            lines.append(f'era5_jobs_active {len(self.traces)}')
+        for name, value in sorted(gauges.items()):
+            lines.append(f'# TYPE era5_{name} gauge')
+            lines.append(f'era5_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, gauges=None):
+        """ Write metrics to self.path, if defined, replacing it atomically
+        """
+        gauges = gauges or {}
+        if not self.path:
+            return
+        if self.path.endswith('.json'):
+            data = self.to_dict()
+            data['gauges'] = gauges
+            text = json.dumps(data, indent=1)
+        else:
+            text = self.prometheus(gauges)
+        tmpfn = self.path + '.tmp'
+        with open(tmpfn, 'w') as f:
+            f.write(text)
+        os.replace(tmpfn, self.path)
+
+
+def get_metrics(cfg):
+    """ Return the metrics shared by all the threads of this process
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(cfg)
+    return _metrics
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Choose the download host for each file from the throughput measured
+# for previous downloads, instead of a fixed list of slow and fast ips
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import json
+import os
+import re
+import threading
+import time
+
+
+# download urls are on hosts with the same address but the last number
+host_re = re.compile(r'^(\w+://\d+\.\d+\.\d+\.)(\d+)(/.*)$')
+
+_mirrors = None
+_mirrors_lock = threading.Lock()
+
+
+def split_url(url):
+    """ Return the last number of the host address and a url template,
+        None if the host is not an ip address
+
+        >>> split_url('http://136.156.133.37/cache-compute-0011/file.nc')
+        ('37', 'http://136.156.133.{}/cache-compute-0011/file.nc')
+        >>> split_url('https://download.ecmwf.int/file.nc')
+        (None, 'https://download.ecmwf.int/file.nc')
+    """
+    m = host_re.match(url)
+    if m is None:
+        return None, url
+    return m.group(2), m.group(1) + '{}' + m.group(3)
+
+
+class MirrorSelector(object):
+    """ Keep a moving average of the download rate of each host and route
+        new downloads to the fastest healthy one. A host that fails or
+        stalls (rate below cfg['stall_rate'] bytes/s) is not used for
+        cfg['demote_time'] seconds, doubled at each consecutive stall.
+        Transfers under cfg['stall_bytes'] bytes or cfg['stall_time'] seconds
+        are too short to tell a stall and never demote a host.
+        Hosts not measured yet are tried first, one download each at the
+        same time so they are measured in parallel, the candidate hosts are
+        cfg['mirrors'] (or the old altips list) and the one in the url.
+        Scores are saved to cfg['mirrorstate'] so they survive restarts.
+    """
+
+    def __init__(self, cfg):
+        self.candidates = [str(ip) for ip in cfg.get('mirrors', cfg.get('altips', []))]
+        self.stall_rate = cfg.get('stall_rate', 524288)
+        self.demote_time = cfg.get('demote_time', 1800)
+        self.stall_bytes = cfg.get('stall_bytes', 16777216)
+        self.stall_time = cfg.get('stall_time', 2)
+        self.alpha = cfg.get('mirror_alpha', 0.3)
+        self.statefn = cfg.get('mirrorstate', os.path.join(cfg['logdir'], 'era5_mirrors.json'))
+        self.lock = threading.Lock()
+        # {host: {'rate': bytes/s, 'stalls': consecutive stalls, 'until': demoted until}}
+        self.hosts = {}
+        # downloads in progress for each host
+        self.active = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.statefn, 'r') as f:
+                self.hosts = json.load(f)
+        except (OSError, ValueError):
+            self.hosts = {}
+
+    def save(self):
+        tmpfn = self.statefn + '.tmp'
+        try:
+            with open(tmpfn, 'w') as f:
+                json.dump(self.hosts, f)
+            os.replace(tmpfn, self.statefn)
+        except OSError:
+            pass
+
+    def score(self, host, now):
+        """ Expected rate for a new download from host, None for hosts
+            not measured yet, -1 for demoted hosts
+        """
+        h = self.hosts.get(host)
+        if h is None:
+            return None
+        if h['until'] > now:
+            return -1
+        return h['rate'] / (1 + self.active.get(host, 0))
+
+    def choose(self, url):
+        """ Return (host, url) with the host replaced by the best one
+        """
+        host, template = split_url(url)
+        if host is None:
+            return None, url
+        now = time.time()
+        with self.lock:
+            candidates = self.candidates + [h for h in [host] if h not in self.candidates]
+            scores = {h: self.score(h, now) for h in candidates}
+            new = [h for h, s in scores.items() if s is None]
+            # new hosts already being measured are not chosen again until
+            # the measured hosts are used
+            idle = [h for h in new if not self.active.get(h, 0)]
+            measured = [h for h in candidates if scores[h] is not None]
+            if idle:
+                # measure new hosts, the original one first
+                best = host if host in idle else idle[0]
+            elif measured and max(scores[h] for h in measured) >= 0:
+                best = max(measured, key=lambda h: (scores[h], h == host))
+            elif new:
+                best = min(new, key=lambda h: (self.active.get(h, 0), h != host))
+            else:
+                best = host
+            self.active[best] = self.active.get(best, 0) + 1
+        return best, template.format(best)
+
+    def record(self, host, nbytes, elapsed, ok):
+        """ Update the score of host after a download transferring nbytes
+            in elapsed seconds, ok is False if the download failed
+        """
+        if host is None:
+            return
+        rate = nbytes / elapsed if ok and elapsed > 0 else 0
+        with self.lock:
+            self.active[host] = max(0, self.active.get(host, 1) - 1)
+            h = self.hosts.setdefault(host, {'rate': rate, 'stalls': 0, 'until': 0})
+            h['rate'] = (1 - self.alpha) * h['rate'] + self.alpha * rate
+            if ok and (nbytes < self.stall_bytes or elapsed < self.stall_time):
+                # too short to tell if the host stalled
+                pass
+            elif rate < self.stall_rate:
+                h['stalls'] += 1
+                h['until'] = time.time() + self.demote_time * 2 ** (h['stalls'] - 1)
+            else:
+                h['stalls'] = 0
+                h['until'] = 0
+            self.save()
+
+    def status(self):
+        """ Return a copy of the hosts scores
+        """
+        with self.lock:
+            return {h: dict(v, active=self.active.get(h, 0)) for h, v in self.hosts.items()}
+
+
+def get_mirrors(cfg):
+    """ Return the mirror selector shared by all the threads of this process
+    """
+    global _mirrors
+    with _mirrors_lock:
+        if _mirrors is None:
+            _mirrors = MirrorSelector(cfg)
+    return _mirrors
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Local stand-in for the CDS api, used by 'era5 bench' to run the whole
+# download pipeline without the live server
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import json
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def pad(b):
+    """ Pad bytes to a multiple of 4 as in the netcdf header
+
+        >>> pad(b'abcde')
+        b'abcde\\x00\\x00\\x00'
+    """
+    return b + b'\x00' * (-len(b) % 4)
+
+
+def netcdf_bytes(size, var='var'):
+    """ Return a netcdf classic file of about size bytes with a single
+        byte variable var, data is a repeated ramp so it can be compressed
+
+        >>> netcdf_bytes(100)[:4]
+        b'CDF\\x01'
+    """
+    def name(s):
+        return struct.pack('>i', len(s)) + pad(s.encode())
+    header_size = 76 + len(pad(var.encode()))
+    n = max(1, size - header_size)
+    header = b'CDF\x01' + struct.pack('>i', 0)
+    # one dimension, no global attributes
+    header += struct.pack('>ii', 10, 1) + name('x') + struct.pack('>i', n)
+    header += struct.pack('>ii', 0, 0)
+    # one variable of type byte along x, no attributes
+    header += struct.pack('>ii', 11, 1) + name(var) + struct.pack('>ii', 1, 0)
+    header += struct.pack('>ii', 0, 0)
+    header += struct.pack('>iii', 1, n + (-n % 4), header_size)
+    data = bytes(range(256)) * (n // 256 + 1)
+    return header + data[:n]
+
+
+class MockCDS(object):
+    """ Minimal CDS api served on localhost: requests are queued for a random
+        time in queue_delay, run for a random time in run_delay, then fail
+        with probability fail_rate or complete with a netcdf file of size bytes.
+        Files are served with Range support from 127.0.0.<host>, download
+        rate is limited for each host in hosts {host: bytes/s}, the host of
+        each result is chosen randomly among them.
+        A listener is bound on 127.0.0.1 for the api and on 127.0.0.<host> for
+        each host, all on the same port and sharing the server state, the
+        server is never reachable from outside the machine.
+    """
+
+    def __init__(self, queue_delay=(1, 5), run_delay=(1, 5), fail_rate=0.0,
+                 size=10485760, hosts={'1': 0}, seed=None):
+        self.queue_delay = queue_delay
+        self.run_delay = run_delay
+        self.fail_rate = fail_rate
+        self.size = size
+        self.hosts = {str(h): r for h, r in hosts.items()}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.stats = {'submitted': 0, 'failed': 0, 'deleted': 0, 'bytes': 0,
+                      'max_active': 0, 'host_bytes': {h: 0 for h in self.hosts}}
+        self.data = netcdf_bytes(size)
+        self.servers = []
+
+    @property
+    def port(self):
+        return self.servers[0].server_port
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}/api/v2'
+
+    def start(self, port=0):
+        """ Start a listener for the api and each host in background threads,
+            if port is 0 a free port is chosen for all of them
+        """
+        mock = self
+
+        class Handler(MockHandler):
+            cds = mock
+
+        addresses = ['127.0.0.1'] + [f'127.0.0.{h}' for h in self.hosts if h != '1']
+        for attempt in range(10):
+            try:
+                for address in addresses:
+                    # hosts use the port chosen for the api
+                    server = ThreadingHTTPServer((address, self.port if self.servers else port), Handler)
+                    server.daemon_threads = True
+                    self.servers.append(server)
+                break
+            except OSError:
+                # port taken on one of the host addresses, try another one
+                for server in self.servers:
+                    server.server_close()
+                self.servers = []
+                if port or attempt == 9:
+                    raise
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def submit(self, request):
+        with self.lock:
+            rid = f'{len(self.tasks):08d}'
+            now = time.time()
+            queued = self.random.uniform(*self.queue_delay)
+            running = self.random.uniform(*self.run_delay)
+            self.tasks[rid] = {'request': request, 'running': now + queued,
+                               'done': now + queued + running,
+                               'fail': self.random.random() < self.fail_rate,
+                               'host': self.random.choice(list(self.hosts))}
+            self.stats['submitted'] += 1
+            active = len([t for t in self.tasks.values() if t['done'] > now])
+            self.stats['max_active'] = max(self.stats['max_active'], active)
+        return self.reply(rid)
+
+    def reply(self, rid):
+        t = self.tasks[rid]
+        now = time.time()
+        if now < t['running']:
+            return {'state': 'queued', 'request_id': rid}
+        if now < t['done']:
+            return {'state': 'running', 'request_id': rid}
+        if t['fail']:
+            return {'state': 'failed', 'request_id': rid,
+                    'error': {'message': 'Mock failure', 'reason': 'fail_rate',
+                              'context': {'traceback': ''}}}
+        return {'state': 'completed', 'request_id': rid, 'content_length': self.size,
+                'content_type': 'application/x-netcdf',
+                'location': f"http://127.0.0.{t['host']}:{self.port}/data/{rid}.nc"}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    cds = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, reply, status=200):
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.startswith('/api/v2/resources/'):
+            return self.send_json({'message': 'Not found'}, 404)
+        self.send_json(self.cds.submit(request))
+
+    def task_id(self):
+        m = re.match(r'^/api/v2/tasks/(\w+)$', self.path)
+        if m is None or m.group(1) not in self.cds.tasks:
+            return None
+        return m.group(1)
+
+    def do_DELETE(self):
+        rid = self.task_id()
+        if rid is None:
+            return self.send_json({'message': 'Not found'}, 404)
+        with self.cds.lock:
+            self.cds.tasks[rid]['done'] = 0
+            self.cds.tasks[rid]['fail'] = True
+            self.cds.stats['deleted'] += 1
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.startswith('/data/'):
+            return self.send_data()
+        rid = self.task_id()
+        if rid is None:
+            return self.send_json({'message': 'Not found'}, 404)
+        reply = self.cds.reply(rid)
+        if reply['state'] == 'failed':
+            with self.cds.lock:
+                if not self.cds.tasks[rid].get('counted'):
+                    self.cds.tasks[rid]['counted'] = True
+                    self.cds.stats['failed'] += 1
+        self.send_json(reply)
+
+    def send_data(self):
+        data = self.cds.data
+        start, end = 0, len(data) - 1
+        m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2) or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        # rate limit of the host the client connected to
+        host = self.connection.getsockname()[0].split('.')[-1]
+        rate = self.cds.hosts.get(host, 0)
+        sent = 0
+        t0 = time.time()
+        try:
+            for pos in range(start, end + 1, 65536):
+                chunk = data[pos:min(pos + 65536, end + 1)]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    delay = sent / rate - (time.time() - t0)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        with self.cds.lock:
+            self.cds.stats['bytes'] += sent
+            if host in self.cds.stats['host_bytes']:
+                self.cds.stats['host_bytes'][host] += sent
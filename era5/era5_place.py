@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Placement of files from staging to the data directories: rename on the same
+# file system, copy in the kernel otherwise, and removal of staging files
+# once their outputs are catalogued
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import errno
+import os
+import shutil
+
+
+def copy_data(fin, fout, size):
+    """ Copy size bytes from file object fin to fout without reading them in
+        user space, using copy_file_range or sendfile when available
+    """
+    infd, outfd = fin.fileno(), fout.fileno()
+    copied = 0
+    for func in [getattr(os, 'copy_file_range', None), os.sendfile]:
+        if func is None:
+            continue
+        try:
+            if func is os.sendfile:
+                os.lseek(outfd, copied, os.SEEK_SET)
+            while copied < size:
+                if func is os.sendfile:
+                    n = func(outfd, infd, copied, size - copied)
+                else:
+                    n = func(infd, outfd, size - copied, copied, copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return
+        except OSError as e:
+            # not supported between these file systems, try next method
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    # sendfile writes from the current offset of outfd
+    fin.seek(copied)
+    fout.seek(copied)
+    shutil.copyfileobj(fin, fout, 4194304)
+
+
+def place_file(src, dst):
+    """ Move src to dst: rename if on the same file system, otherwise copy to
+        a temporary name, rename it to dst and remove src, so dst is never
+        partially written. Return 'rename' or 'copy'
+    """
+    try:
+        os.replace(src, dst)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmpfn = dst + '.tmp'
+    try:
+        with open(src, 'rb') as fin, open(tmpfn, 'wb') as fout:
+            copy_data(fin, fout, os.fstat(fin.fileno()).st_size)
+            fout.flush()
+            os.fsync(fout.fileno())
+        shutil.copystat(src, tmpfn)
+        os.replace(tmpfn, dst)
+    except BaseException:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+    os.remove(src)
+    return 'copy'
+
+
+def purge_staging(path, era5log):
+    """ Remove staging file path and its download progress file if any
+    """
+    for fn in [path, path + '.ranges']:
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            era5log.warning(f'Cannot remove staging file {fn}: {e}')
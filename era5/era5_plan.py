@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Plans written by 'download --plan' and 'scan --plan': the list of requests
+# not in the catalogue yet with their estimated size and destinations, as json,
+# which can be reviewed, split in shards and passed to 'era5 execute'
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import json
+import os
+import sys
+import time
+from era5.era5_cost import estimate
+
+
+plan_version = 1
+
+
+def make_plan(rqlist, args):
+    """ Return the plan for the list of requests rqlist built from args
+    """
+    requests = []
+    total = {'fields': 0, 'bytes': 0}
+    for dsid, rdict, staging, target, ip, user, splits in rqlist:
+        cost = estimate(dsid, rdict)
+        total['fields'] += cost['fields']
+        total['bytes'] += cost['bytes']
+        requests.append({'dsid': dsid, 'request': rdict, 'staging': staging,
+                         'target': target, 'ip': ip, 'user': user,
+                         'splits': [list(s) for s in splits],
+                         'fields': cost['fields'], 'bytes': cost['bytes']})
+    return {'version': plan_version, 'created': time.strftime('%FT%T'),
+            'args': args, 'total': dict(total, requests=len(requests)),
+            'requests': requests}
+
+
+def write_plan(plan, path):
+    """ Write plan as json to path, '-' for stdout
+    """
+    text = json.dumps(plan, indent=1)
+    if path == '-':
+        sys.stdout.write(text + '\n')
+        return
+    with open(path + '.tmp', 'w') as f:
+        f.write(text + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def plan_requests(plan, shard=None):
+    """ Return the list of requests in plan, as built by build_requests.
+        shard (index, count) selects every count-th request starting at index
+
+        >>> plan = {'version': 1, 'requests': [{'dsid': 'd', 'request': {}, 'staging': 's',
+        ...         'target': f't{k}', 'ip': '', 'user': '1', 'splits': []} for k in range(5)]}
+        >>> [r[3] for r in plan_requests(plan, (1, 2))]
+        ['t1', 't3']
+    """
+    if plan.get('version') != plan_version:
+        raise Exception(f"Unsupported plan version {plan.get('version')}")
+    rqlist = [(r['dsid'], r['request'], r['staging'], r['target'], r['ip'], r['user'],
+               [tuple(s) for s in r['splits']]) for r in plan['requests']]
+    if shard is not None:
+        index, count = shard
+        rqlist = rqlist[index::count]
+    return rqlist
+
+
+def read_plan(path, shard=None):
+    """ Read plan from json file path and return its list of requests
+    """
+    with open(path) as f:
+        return plan_requests(json.load(f), shard)
+
+
+def parse_shard(value):
+    """ Parse a shard passed as index/count, index starts from 0
+
+        >>> parse_shard('2/4')
+        (2, 4)
+    """
+    index, count = [int(x) for x in value.split('/')]
+    if not 0 <= index < count:
+        raise ValueError(f'Invalid shard {value}, index must be between 0 and {count - 1}')
+    return index, count
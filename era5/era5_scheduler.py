@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Two-stage scheduler for CDS requests: all requests are submitted up front,
+# a single poller follows them and completed results are passed to a pool
+# of download workers
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import time
+import traceback
+import yaml
+from collections import Counter, deque
+from multiprocessing.dummy import Pool as ThreadPool
+import era5.cdsapi as cdsapi
+from era5.era5_jobs import get_jobs
+from era5.era5_metrics import get_metrics
+
+
+class Scheduler(object):
+    """ Submit requests to CDS without blocking a thread per request.
+        Each user can have at most cfg['maxjobs'] requests queued or running
+        on the CDS server, a single loop polls all of them and hands the
+        completed ones to a pool of nthreads download workers.
+        The download callable is called as download(r, res), where r is the
+        request tuple built by api_request and res the cdsapi Result.
+        The state of each request is saved in the job table, requests already
+        submitted by an interrupted run are followed instead of submitted again.
+
+        Requests with a lower priority value are submitted first, requests
+        with the same priority are shared fairly between requesters.
+        Each request is submitted with the CDS account with the shortest
+        expected wait, based on its active requests and on how long its
+        recent requests waited to complete. If urgent requests are pending and
+        all accounts are busy, lower priority requests still queued on the
+        server are cancelled and queued again.
+    """
+
+    def __init__(self, cfg, era5log, download, nthreads):
+        self.cfg = cfg
+        self.era5log = era5log
+        self.download = download
+        self.nthreads = nthreads
+        self.maxjobs = cfg.get('maxjobs', 4)
+        self.poll_interval = cfg.get('poll_interval', 30)
+        self.users = list(cfg['users'])
+        self.clients = {}
+        self.jobs = get_jobs(cfg)
+        self.metrics = get_metrics(cfg)
+        # pending requests as {priority: {requester: deque of requests}}
+        # requests currently queued or running on the server
+        self.pending = {}
+        self.active = []
+        # priority and requester of each target, submission time of active
+        # requests and time they were first seen running
+        self.meta = {}
+        self.submitted = {}
+        self.running = {}
+        # moving average of seconds from submission to completion for each user
+        # and number of requests submitted for each requester
+        self.wait = {}
+        self.served = Counter()
+        self.added = set()
+        self.pool = ThreadPool(nthreads)
+
+    def client(self, user):
+        """ Return the cdsapi client for user, clients are created once
+            so requests for the same user share their connection pool
+        """
+        if user not in self.clients:
+            rcfile = self.cfg.get('cdsapirc', '/mnt/pvol/era5/.cdsapirc')
+            # set api key explicitly so you can alternate
+            with open(f'{rcfile}{user}', 'r') as f:
+                credentials = yaml.safe_load(f)
+            # remote requests are deleted explicitly once downloaded
+            self.clients[user] = cdsapi.Client(url=credentials['url'],
+                                 key=credentials['key'], verify=1, delete=False)
+        return self.clients[user]
+
+    def submit(self, r):
+        """ Submit request r to CDS, return the first reply or None if failed
+        """
+        self.era5log.info(f'Requesting {r[2]} as user {r[5]} ... ')
+        self.era5log.info(f'Request: {r[1]}')
+        try:
+            reply = self.client(r[5]).submit(r[0], r[1])
+        except Exception as e:
+            self.era5log.error(f'ERROR: {e}')
+            self.metrics.inc('submit_errors', job=r[3])
+            self.jobs.update(r[3], 'failed')
+            return None
+        self.metrics.inc('requests_submitted', job=r[3])
+        self.submitted[r[3]] = time.time()
+        self.jobs.update(r[3], 'submitted', request_id=reply.get('request_id'), user=r[5])
+        return reply
+
+    def poll(self, r, reply):
+        """ Update state of submitted request r
+            Return (reply, res), res is the Result if the request is completed
+            Return (None, None) if the request failed
+        """
+        try:
+            c = self.client(r[5])
+            if reply['state'] in ('queued', 'running'):
+                reply = c.poll(reply)
+            res = c.result(reply)
+        except Exception as e:
+            self.era5log.error(f'ERROR: {r[2]} {e}')
+            self.metrics.inc('requests_failed', job=r[3])
+            self.jobs.update(r[3], 'failed')
+            self.submitted.pop(r[3], None)
+            self.running.pop(r[3], None)
+            return None, None
+        now = time.time()
+        if reply['state'] == 'running' and r[3] not in self.running:
+            self.running[r[3]] = now
+            if r[3] in self.submitted:
+                self.metrics.observe('queue', now - self.submitted[r[3]], r[3])
+        if res is not None:
+            self.jobs.update(r[3], 'completed', location=res.location,
+                             size=res.content_length)
+            if r[3] in self.running:
+                self.metrics.observe('run', now - self.running.pop(r[3]), r[3])
+            elif r[3] in self.submitted:
+                # completed before being seen running
+                self.metrics.observe('queue', now - self.submitted[r[3]], r[3])
+            if r[3] in self.submitted:
+                waited = now - self.submitted.pop(r[3])
+                self.wait[r[5]] = 0.7 * self.wait.get(r[5], waited) + 0.3 * waited
+        return reply, res
+
+    def start_download(self, r, res):
+        """ Pass completed request r to the download threads, a download
+            raising an exception is logged and its job failed
+        """
+        def failed(e):
+            self.era5log.error(f'ERROR: download of {r[2]} failed: {e}\n'
+                               + ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+            self.metrics.inc('downloads_failed', job=r[3])
+            self.jobs.update(r[3], 'failed')
+
+        self.pool.apply_async(self.download, (r, res), error_callback=failed)
+
+    def resume(self, r, job):
+        """ Reattach request r to the state saved by a previous run
+            Return reply to poll, or None if the request needs to be submitted
+        """
+        rid = job['request_id']
+        if job['state'] in ('completed', 'downloaded') and job['location']:
+            # download directly, partial downloads are resumed by the downloader
+            self.era5log.info(f'Resuming download of {r[2]}')
+            reply = {'state': 'completed', 'request_id': rid, 'location': job['location'],
+                     'content_length': job['size'], 'content_type': None}
+            self.start_download(r, self.client(r[5]).result(reply))
+            return None
+        self.era5log.info(f'Reattaching to request {rid} for {r[2]}')
+        return {'state': 'queued', 'request_id': rid, 'reattached': True}
+
+    def add(self, rqlist, priority=1, requester=None):
+        """ Add requests in rqlist to the queue, requests with a lower priority
+            value are submitted first. Requests for targets already followed
+            by this scheduler are skipped
+        """
+        for r in rqlist:
+            job = self.jobs.get(r[3])
+            if r[3] in self.added and job and job['state'] not in ('catalogued', 'failed'):
+                self.era5log.info(f'Already in progress {r[3]}')
+                continue
+            self.added.add(r[3])
+            self.meta[r[3]] = (priority, requester)
+            if job and job['request_id'] and job['state'] in ('submitted', 'completed', 'downloaded'):
+                # request has to be followed with the account used to submit it
+                r = r[:5] + (job['user'],) + r[6:]
+                reply = self.resume(r, job)
+                if reply is not None:
+                    self.active.append((r, reply))
+            else:
+                self.jobs.plan(r)
+                self.push(r)
+
+    def drop(self, targets):
+        """ Stop following the requests for targets, pending or active,
+            the requests on the server are left to whoever took them over
+        """
+        for queues in self.pending.values():
+            for requester, rqueue in queues.items():
+                queues[requester] = deque(r for r in rqueue if r[3] not in targets)
+        self.active = [a for a in self.active if a[0][3] not in targets]
+        for target in targets:
+            self.submitted.pop(target, None)
+            self.running.pop(target, None)
+            self.added.discard(target)
+
+    def push(self, r, first=False):
+        priority, requester = self.meta[r[3]]
+        rqueue = self.pending.setdefault(priority, {}).setdefault(requester, deque())
+        if first:
+            rqueue.appendleft(r)
+        else:
+            rqueue.append(r)
+
+    def top_priority(self):
+        """ Return the lowest priority value with pending requests, None if none
+        """
+        priorities = [p for p, queues in self.pending.items() if any(queues.values())]
+        return min(priorities) if priorities else None
+
+    def next_request(self, priority):
+        """ Return next request with priority, from the requester with
+            fewer active requests, then with fewer requests submitted
+        """
+        queues = {k: q for k, q in self.pending[priority].items() if q}
+        nactive = Counter(self.meta[a[0][3]][1] for a in self.active)
+        requester = min(queues, key=lambda k: (nactive[k], self.served[k]))
+        self.served[requester] += 1
+        return queues[requester].popleft()
+
+    def user_load(self):
+        """ Return number of active requests of each account
+        """
+        return Counter(a[0][5] for a in self.active)
+
+    def pick_user(self):
+        """ Return the account with the shortest expected wait, None if all
+            accounts have maxjobs active requests. The expected wait is the
+            number of active requests + 1 times the recent average wait,
+            accounts not used yet get the shortest average
+        """
+        nactive = self.user_load()
+        free = [u for u in self.users if nactive[u] < self.maxjobs]
+        if not free:
+            return None
+        default = min(self.wait.values()) if self.wait else 1
+        return min(free, key=lambda u: ((nactive[u] + 1) * self.wait.get(u, default), nactive[u]))
+
+    def preempt(self, priority):
+        """ Cancel the most recent request with a priority value higher than
+            priority which is still queued on the server and queue it again
+            Return the account freed, None if no request can be cancelled
+        """
+        queued = [a for a in self.active if a[1].get('state') == 'queued'
+                  and self.meta[a[0][3]][0] > priority]
+        if not queued:
+            return None
+        r, reply = max(queued, key=lambda a: (self.meta[a[0][3]][0], self.submitted.get(a[0][3], 0)))
+        try:
+            self.client(r[5]).cancel(reply)
+        except Exception as e:
+            self.era5log.error(f'ERROR: cannot cancel {r[2]} {e}')
+            return None
+        self.era5log.info(f'Cancelled {r[2]} for higher priority requests')
+        self.active.remove((r, reply))
+        self.submitted.pop(r[3], None)
+        self.metrics.inc('requests_preempted', job=r[3])
+        self.jobs.update(r[3], 'planned', request_id=None)
+        self.push(r, first=True)
+        return r[5]
+
+    def step(self):
+        """ Submit pending requests while accounts are available, then poll
+            every active request once and download the completed ones.
+            Return True if there are still requests pending or active
+        """
+        priority = self.top_priority()
+        while priority is not None:
+            user = self.pick_user()
+            if user is None:
+                user = self.preempt(priority)
+                if user is None:
+                    break
+            r = self.next_request(priority)
+            r = r[:5] + (user,) + r[6:]
+            reply = self.submit(r)
+            if reply is not None:
+                self.active.append((r, reply))
+            priority = self.top_priority()
+        # poll every active request once, pass the completed ones to the pool
+        still_active = []
+        for r, old_reply in self.active:
+            reply, res = self.poll(r, old_reply)
+            if res is not None:
+                self.era5log.debug(f'Request completed: {r[2]}')
+                self.start_download(r, res)
+            elif reply is not None:
+                still_active.append((r, reply))
+            elif old_reply.get('reattached'):
+                # request from previous run is not available anymore, submit it again first
+                self.jobs.plan(r)
+                self.push(r, first=True)
+        self.active = still_active
+        return self.top_priority() is not None or bool(self.active)
+
+    def close(self):
+        """ Wait for the downloads already started
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def run(self, rqlist):
+        """ Submit all requests in rqlist and download them as they complete
+        """
+        self.add(rqlist)
+        while self.step():
+            if self.active:
+                time.sleep(self.poll_interval)
+        self.close()
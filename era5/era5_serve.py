@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Queue daemon replacing the cron wrapper: request files are picked up as soon
+# as they are saved and all requests share the same scheduler and pools
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import glob
+import json
+import os
+import signal
+import time
+from era5.era5_scheduler import Scheduler
+from era5.era5_jobs import get_jobs
+from era5.era5_governor import get_governor
+from era5.era5_metrics import get_metrics
+
+
+class Server(object):
+    """ Load the request files saved by 'era5 download -q' in cfg['requestdir']
+        as they appear, files in the Urgent/ folder are queued first and
+        requests with the same priority are shared fairly between requesters.
+        All requests share one scheduler, so one set of download threads
+        and one compression pool, files are catalogued as soon as they are
+        compressed. A request file is moved to cfg['completedir'] when all its
+        files are catalogued or failed.
+        The build callable returns the list of request tuples for the
+        arguments in a request file, as api_request does.
+    """
+
+    def __init__(self, cfg, era5log, download, build, nthreads):
+        self.era5log = era5log
+        self.build = build
+        self.requestdir = cfg['requestdir']
+        self.completedir = cfg.get('completedir', os.path.join(self.requestdir, 'Completed'))
+        self.poll_interval = cfg.get('poll_interval', 30)
+        self.scheduler = Scheduler(cfg, era5log, download, nthreads)
+        self.jobs = get_jobs(cfg)
+        self.governor = get_governor(cfg)
+        self.metrics = get_metrics(cfg)
+        # request files loaded: list of their targets
+        self.requests = {}
+        self.stopped = False
+
+    def scan(self):
+        """ Return list of (priority, path) of new request files,
+            urgent requests first then in order of modification time
+        """
+        found = []
+        dirs = [os.path.join(self.requestdir, 'Urgent'), self.requestdir]
+        for priority, d in enumerate(dirs):
+            files = [(os.path.getmtime(f), f) for f in
+                     glob.glob(os.path.join(d, 'era5_request*.json'))]
+            found.extend([(priority, f) for mtime, f in sorted(files)
+                          if f not in self.requests])
+        return found
+
+    def load(self, path, priority):
+        """ Build the requests in file path and add them to the scheduler
+        """
+        try:
+            with open(path, 'r') as fj:
+                args = json.load(fj)
+        except (OSError, ValueError) as e:
+            # file could still be written, it will be read at next scan
+            self.era5log.debug(f'Cannot read {path}: {e}')
+            return
+        self.era5log.info(f'Loading request {path}')
+        try:
+            rqlist = self.build(args['format'], args['stream'],
+                                args['params'], args['year'], args['months'],
+                                args['timestep'], args['back'], args.get('coalesce', False))
+        except Exception as e:
+            self.era5log.error(f'ERROR: invalid request {path}: {e}')
+            rqlist = []
+        self.requests[path] = [r[3] for r in rqlist]
+        # requests without a requester have their own share
+        requester = args.get('requester', os.path.basename(path))
+        self.scheduler.add(rqlist, priority, requester)
+
+    def complete(self):
+        """ Move the request files with all their files done to completedir
+        """
+        for path, targets in list(self.requests.items()):
+            if self.jobs.finished(targets):
+                os.makedirs(self.completedir, exist_ok=True)
+                os.replace(path, os.path.join(self.completedir, os.path.basename(path)))
+                del self.requests[path]
+                self.era5log.info(f'Finished request {path}')
+
+    def write_metrics(self):
+        """ Write metrics file with the current queue and downloads status
+        """
+        gauges = {'requests_pending': sum(len(q) for queues in self.scheduler.pending.values()
+                                          for q in queues.values()),
+                  'requests_active': len(self.scheduler.active),
+                  'request_files': len(self.requests)}
+        status = self.governor.status()
+        self.era5log.debug(f'Downloads: {status}')
+        gauges.update({f'downloads_{k}': v for k, v in status.items()})
+        try:
+            self.metrics.write(gauges)
+        except OSError as e:
+            self.era5log.error(f'ERROR: cannot write metrics: {e}')
+
+    def stop(self, signum, frame):
+        self.era5log.info('Stopping, unfinished requests will be resumed at next start')
+        self.stopped = True
+
+    def wait(self, seconds):
+        """ Sleep for seconds or until stopped
+        """
+        end = time.time() + seconds
+        while not self.stopped and time.time() < end:
+            time.sleep(max(0, min(1, end - time.time())))
+
+    def serve(self):
+        """ Scan for new requests, submit and poll them until stopped
+            by SIGTERM or SIGINT. Downloads already started are completed
+            before returning
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.era5log.info(f'Watching {self.requestdir}')
+        while not self.stopped:
+            for priority, path in self.scan():
+                self.load(path, priority)
+            self.scheduler.step()
+            self.complete()
+            self.write_metrics()
+            self.wait(self.poll_interval)
+        self.scheduler.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Integrity of downloaded files: checksums computed while a file is downloaded
+# and fast checks of the file structure, reading only headers, so corrupted
+# files are downloaded again before being compressed
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import hashlib
+import os
+import struct
+import threading
+
+
+# size in bytes of netcdf classic types: byte, char, short, int, float, double
+# and the CDF-5 types: ubyte, ushort, uint, int64, uint64
+nc_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+hdf5_signature = b'\x89HDF\r\n\x1a\n'
+
+
+def new_digest(cfg):
+    """ Return a new hash object for the algorithm in cfg['checksum'], md5 by default
+    """
+    return hashlib.new(cfg.get('checksum', 'md5'))
+
+
+def file_checksum(path, digest, blocksize=4194304):
+    """ Update digest with the content of path and return its hex digest
+    """
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class OrderedHash(object):
+    """ Hash a file while its ranges are downloaded in any order, the bytes
+        following the ones already hashed are read back from the file
+        (usually still in the page cache) as soon as they are written.
+        update() can be called by any download thread, it returns immediately
+        if another thread is hashing.
+    """
+
+    def __init__(self, digest, path, ranges, lock):
+        self.digest = digest
+        self.fd = os.open(path, os.O_RDONLY)
+        self.ranges = ranges
+        self.ranges_lock = lock
+        self.lock = threading.Lock()
+        self.pos = 0
+
+    def available(self):
+        """ Return number of bytes written after pos
+        """
+        with self.ranges_lock:
+            for start, (end, done) in self.ranges.items():
+                if start <= self.pos < start + done:
+                    return start + done - self.pos
+        return 0
+
+    def update(self, wait=False):
+        if not self.lock.acquire(blocking=wait):
+            return
+        try:
+            n = self.available()
+            while n > 0:
+                block = os.pread(self.fd, min(n, 4194304), self.pos)
+                if not block:
+                    break
+                self.digest.update(block)
+                self.pos += len(block)
+                n = self.available()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def check_classic(f, size):
+    """ Parse a netcdf classic header and check all variables data fit in the file
+        Return an error message or None
+    """
+    def read(n):
+        b = f.read(n)
+        if len(b) < n:
+            raise ValueError('header truncated')
+        return b
+
+    def integer():
+        return struct.unpack('>i', read(4))[0]
+
+    def offset():
+        return struct.unpack('>q', read(8))[0] if version != 1 else integer()
+
+    def count():
+        return struct.unpack('>q', read(8))[0] if version == 5 else integer()
+
+    def name():
+        n = count()
+        return read(n + (-n % 4))[:n].decode('utf-8', 'replace')
+
+    def skip_atts():
+        tag, n = integer(), count()
+        for i in range(n):
+            name()
+            nc_type, nelems = integer(), count()
+            if nc_type not in nc_sizes:
+                raise ValueError(f'unknown attribute type {nc_type}')
+            nbytes = nelems * nc_sizes[nc_type]
+            read(nbytes + (-nbytes % 4))
+
+    version = read(4)[3]
+    numrecs = count()
+    tag, ndims = integer(), count()
+    dims = []
+    for i in range(ndims):
+        name()
+        dims.append(count())
+    skip_atts()
+    tag, nvars = integer(), count()
+    recsize = 0
+    records = []
+    for i in range(nvars):
+        vname = name()
+        dimids = [count() for d in range(count())]
+        skip_atts()
+        nc_type, vsize, begin = integer(), count(), offset()
+        if dimids and dims[dimids[0]] == 0:
+            recsize += vsize
+            records.append((vname, begin, vsize, nc_type, dimids))
+        # the last variable can miss the padding to 4 bytes
+        elif vsize > 0 and begin + vsize > size + 3:
+            return f'variable {vname} data ends after end of file'
+    if len(records) == 1:
+        # records of a single record variable are not padded
+        vname, begin, vsize, nc_type, dimids = records[0]
+        vsize = nc_sizes.get(nc_type, 1)
+        for d in dimids[1:]:
+            vsize *= dims[d]
+        recsize = vsize
+        records = [(vname, begin, vsize, nc_type, dimids)]
+    for vname, begin, vsize, nc_type, dimids in records:
+        if numrecs > 0 and begin + (numrecs - 1) * recsize + vsize > size + 3:
+            return f'record {numrecs} of {vname} ends after end of file'
+    return None
+
+
+def check_hdf5(f, size):
+    """ Check the HDF5 superblock and that end of file address is within the file
+        Return an error message or None
+    """
+    # superblock can be at 0, 512, 1024, 2048 ...
+    base = 0
+    while True:
+        f.seek(base)
+        if f.read(8) == hdf5_signature:
+            break
+        base = 512 if base == 0 else base * 2
+        if base >= size:
+            return 'HDF5 signature not found'
+    version = f.read(1)[0]
+    if version in (0, 1):
+        head = f.read(15 if version == 0 else 19)
+        osize = head[4]
+    elif version in (2, 3):
+        osize = f.read(3)[0]
+    else:
+        return f'unknown HDF5 superblock version {version}'
+    if osize not in (2, 4, 8):
+        return f'invalid size of offsets {osize}'
+    fmt = {2: '<H', 4: '<I', 8: '<Q'}[osize]
+    addrs = [struct.unpack(fmt, f.read(osize))[0] for i in range(3)]
+    # superblock v0/1: base, free-space, eof; v2/3: base, extension, eof
+    # eof is relative to the base address
+    eof = addrs[0] + addrs[2]
+    if eof > size:
+        return f'file truncated: {size} bytes, HDF5 end of file at {eof}'
+    return None
+
+
+def check_file(path):
+    """ Check the structure of a downloaded file reading only its header and trailer,
+        netcdf (classic or netcdf4/HDF5), grib, tgz and zip are checked
+        Return an error message or None if the file looks complete
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 'empty file'
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(8)
+            f.seek(0)
+            if magic[:3] == b'CDF' and magic[3] in (1, 2, 5):
+                return check_classic(f, size)
+            if magic == hdf5_signature or path.endswith('.nc'):
+                return check_hdf5(f, size)
+            if magic[:4] == b'GRIB':
+                f.seek(size - 4)
+                return None if f.read(4) == b'7777' else 'last GRIB message truncated'
+            if magic[:2] == b'\x1f\x8b':
+                return None
+            if magic[:4] == b'PK\x03\x04':
+                # end of central directory record is in the last 64KB
+                f.seek(max(0, size - 65558))
+                return None if b'PK\x05\x06' in f.read() else 'zip central directory missing'
+            if path.endswith(('.grib', '.tgz', '.zip')):
+                return 'unknown file signature'
+    except (ValueError, IndexError, struct.error, OSError) as e:
+        return f'invalid header: {e}'
+    return None
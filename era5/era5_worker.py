@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+# Author: Paola Petrelli <paola.petrelli@utas.edu.au> for CLEx
+#         Matt Nethery <matt.nethery@nci.org.au> for NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Worker run by 'era5 worker': claims jobs from the job table shared by all
+# workers, on this or other hosts, so downloads and compression of a large
+# plan are spread across nodes
+# contact: paolap@utas.edu.au
+# last updated 18/10/2026
+
+import os
+import signal
+import socket
+import threading
+import time
+from collections import Counter
+from era5.era5_scheduler import Scheduler
+from era5.era5_jobs import get_jobs
+from era5.era5_governor import get_governor
+from era5.era5_metrics import get_metrics
+
+
+class SharedScheduler(Scheduler):
+    """ Scheduler of a worker, active requests of each account are counted
+        in the job table so all workers together keep at most maxjobs
+        requests for each account
+    """
+
+    def user_load(self):
+        return Counter(self.jobs.user_load())
+
+
+class Worker(object):
+    """ Claim jobs queued by 'era5 execute --enqueue' and run them with a
+        scheduler, download threads and compression pool of this process.
+        A worker holds at most cfg['worker_jobs'] unfinished jobs, each
+        claimed job is leased for cfg['lease_time'] seconds and the lease is
+        renewed every cfg['heartbeat'] seconds by a thread running until the
+        jobs are released, also while downloads and compressions finish after
+        the worker is stopped. Jobs of a worker which stops renewing them are
+        claimed by other workers when the lease expires, requests already
+        submitted are followed with their request id. A worker which finds
+        some of its jobs taken over stops following them and doesn't update them.
+        The worker returns when no jobs are left, or keeps waiting for new
+        jobs if wait is True, until stopped by SIGTERM or SIGINT.
+    """
+
+    def __init__(self, cfg, era5log, download, nthreads, wait=False):
+        self.era5log = era5log
+        self.id = f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_time = cfg.get('lease_time', 600)
+        self.heartbeat = cfg.get('heartbeat', 60)
+        self.maxclaim = cfg.get('worker_jobs', cfg.get('maxjobs', 4) * len(cfg['users']) + nthreads)
+        self.poll_interval = cfg.get('poll_interval', 30)
+        self.scheduler = SharedScheduler(cfg, era5log, download, nthreads)
+        self.jobs = get_jobs(cfg)
+        # job updates of this process are fenced by the worker id
+        self.jobs.owner = self.id
+        self.governor = get_governor(cfg)
+        self.metrics = get_metrics(cfg)
+        self.wait_jobs = wait
+        self.stopped = False
+        # targets claimed and not finished, and those taken over by other workers
+        self.lock = threading.Lock()
+        self.inflight = set()
+        self.lost = set()
+        self.released = threading.Event()
+        self.heart = None
+
+    def claim(self):
+        """ Claim jobs up to maxclaim unfinished jobs and add them to the scheduler
+            Return number of jobs claimed
+        """
+        owned = self.jobs.owned(self.id)
+        self.check(owned)
+        n = self.maxclaim - owned
+        if n <= 0:
+            return 0
+        rqlist = self.jobs.claim(self.id, n, self.lease_time)
+        if rqlist:
+            self.era5log.info(f'Worker {self.id} claimed {len(rqlist)} jobs')
+            with self.lock:
+                self.inflight.update(r[3] for r in rqlist)
+            self.scheduler.add(rqlist)
+        return len(rqlist)
+
+    def check(self, owned):
+        """ Compare the number of unfinished jobs owned with the jobs in flight,
+            if fewer, forget the finished jobs and record the ones taken over
+        """
+        with self.lock:
+            if owned >= len(self.inflight):
+                return
+            inflight = set(self.inflight)
+        lost = set()
+        for target, (owner, state) in self.jobs.ownership(inflight).items():
+            if owner != self.id:
+                lost.add(target)
+            elif state not in ('catalogued', 'failed'):
+                continue
+            with self.lock:
+                self.inflight.discard(target)
+        if lost:
+            self.era5log.warning(f'Worker {self.id} lost {len(lost)} jobs to other workers')
+            self.metrics.inc('jobs_lost', len(lost))
+            with self.lock:
+                self.lost |= lost
+
+    def beat(self):
+        """ Renew the lease of the jobs owned and write metrics
+        """
+        owned = self.jobs.renew(self.id, self.lease_time)
+        self.check(owned)
+        gauges = {'worker_jobs': owned,
+                  'requests_active': len(self.scheduler.active)}
+        gauges.update({f'downloads_{k}': v for k, v in self.governor.status().items()})
+        try:
+            self.metrics.write(gauges)
+        except OSError as e:
+            self.era5log.error(f'ERROR: cannot write metrics: {e}')
+
+    def stop(self, signum, frame):
+        self.era5log.info(f'Stopping worker {self.id}, its unfinished jobs will be released')
+        self.stopped = True
+
+    def beats(self):
+        """ Renew the leases every heartbeat seconds until the jobs are released
+        """
+        while not self.released.wait(self.heartbeat):
+            try:
+                self.beat()
+            except Exception as e:
+                self.era5log.error(f'ERROR: worker heartbeat failed: {e}')
+
+    def wait(self, seconds):
+        """ Sleep for seconds or until stopped
+        """
+        end = time.time() + seconds
+        while not self.stopped and time.time() < end:
+            time.sleep(max(0, min(1, end - time.time())))
+
+    def run(self):
+        """ Claim and run jobs until there are none left or the worker is
+            stopped. Downloads already started are completed before returning
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.era5log.info(f'Worker {self.id} started')
+        self.beat()
+        self.heart = threading.Thread(target=self.beats, daemon=True)
+        self.heart.start()
+        while not self.stopped:
+            with self.lock:
+                lost, self.lost = self.lost, set()
+            if lost:
+                self.scheduler.drop(lost)
+            claimed = self.claim()
+            busy = self.scheduler.step()
+            if not (busy or claimed or self.wait_jobs) and self.jobs.owned(self.id) == 0:
+                break
+            # poll CDS every poll_interval, check for new jobs and finished downloads more often
+            self.wait(self.poll_interval if self.scheduler.active else min(5, self.poll_interval))
+        self.scheduler.close()
+
+    def release(self):
+        """ Stop the heartbeat and release the unfinished jobs so other
+            workers can claim them, to call after the compression pool is closed
+        """
+        self.released.set()
+        if self.heart is not None:
+            self.heart.join()
+        self.jobs.release(self.id)
+        with self.lock:
+            self.inflight.clear()
+        self.beat()
+        self.era5log.info(f'Worker {self.id} stopped')
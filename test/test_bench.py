@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import sys
+
+
+def test_bench_two_hosts(tmp_path):
+    # bench runs in its own process, it sets the process wide configuration
+    p = subprocess.run([sys.executable, '-m', 'era5.cli', 'bench', '--vars', '2', '--months', '2',
+                        '--size', '1', '--queue-delay', '0,1', '--run-delay', '0,1',
+                        '--hosts', '1:0,2:0', '--workdir', str(tmp_path), '--json'],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300)
+    assert p.returncode == 0, p.stderr.decode()
+    res = json.loads(p.stdout)
+    assert res['catalogued'] == 4
+    assert 'downloads_failed' not in res['counters']
+    # both hosts are measured, each listens on its own loopback address
+    assert all(n > 0 for n in res['server']['host_bytes'].values())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright 2019 ARC Centre of Excellence for Climate Extremes (CLEx) and NCI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing
+import os
+import threading
+import era5.era5_download as dl
+
+
+class FakeResponse(object):
+    def __init__(self, session, data, start, end):
+        self.session = session
+        self.data = data[start:end + 1]
+        self.status_code = 206
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for k in range(0, len(self.data), chunk_size):
+            with self.session.lock:
+                if self.session.kill_after is not None and self.session.sent >= self.session.kill_after:
+                    # process killed in the middle of the transfer
+                    os._exit(1)
+                self.session.sent += chunk_size
+            yield self.data[k:k + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """ Serve data for byte range requests, recording the first byte requested
+    """
+    def __init__(self, data, kill_after=None):
+        self.data = data
+        self.kill_after = kill_after
+        self.sent = 0
+        self.starts = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers, stream, timeout):
+        start, end = [int(x) for x in headers['Range'][6:].split('-')]
+        self.starts.append(start)
+        return FakeResponse(self, self.data, start, end)
+
+
+def download(session, target, cfg):
+    return dl.range_download('http://host/file.nc', target, len(session.data), cfg,
+                             logging.getLogger('test'))
+
+
+def test_resume_after_kill(tmp_path, monkeypatch):
+    data = os.urandom(64 * 1024)
+    target = str(tmp_path / 'file.nc')
+    cfg = {'nthreads': 1, 'staging': str(tmp_path), 'segments': 2, 'min_segment': 1024,
+           'chunk_size': 1024, 'retry': 1, 'state_bytes': 1024, 'metrics': None}
+    session = FakeSession(data, kill_after=20 * 1024)
+    monkeypatch.setattr(dl, 'get_session', lambda cfg: session)
+    ctx = multiprocessing.get_context('fork')
+    p = ctx.Process(target=download, args=(session, target, cfg))
+    p.start()
+    p.join()
+    assert p.exitcode == 1
+    ranges = dl.read_state(target + '.ranges', len(data))
+    done = sum(d for e, d in ranges.values())
+    # progress is saved while downloading, not only at the start
+    assert 16 * 1024 <= done <= 20 * 1024
+    session = FakeSession(data)
+    monkeypatch.setattr(dl, 'get_session', lambda cfg: session)
+    assert download(session, target, cfg)
+    assert sorted(session.starts) == sorted(s + d for s, (e, d) in ranges.items())
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(target + '.ranges')